@@ -3,7 +3,7 @@ from nhd.NHDCommon import NHDCommon
 import logging
 import os
 from colorlog import ColoredFormatter
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 class GpuType(Enum):
     GPU_TYPE_ALL = 0
@@ -229,6 +229,28 @@ class CfgTopology:
 
         return groups
 
+    def GetTotalDemand(self) -> Dict:
+        """ Returns the node-wide totals this topology needs: GPUs, logical CPU cores, hugepages, and the (rx, tx)
+            bandwidth each group needs from a single NIC. A node without at least this much free can't fit
+            the topology, though having it doesn't guarantee a fit. """
+        cpus = self.GetTotalCpusRequested()
+        nics = self.GetTotalNICsRequested()
+        return {'gpu': sum(self.GetTotalGpusRequested()),
+                'cpu': sum(p[0][0] + p[1][0] for p in cpus['proc']) + cpus['misc'][0],
+                'nic': [n for n in nics if n[0] > 0 or n[1] > 0],
+                'hugepages': self.hugepages_gb}
+
+    def GetRequestShape(self) -> Tuple:
+        """ Returns a hashable summary of everything the matcher looks at when placing this topology. Two topologies
+            with the same shape fit on exactly the same nodes. """
+        cpus = self.GetTotalCpusRequested()
+        return (self.map_type,
+                tuple(self.GetTotalGpusRequested()),
+                tuple((p[0][0], p[0][1], p[1][0], p[1][1]) for p in cpus['proc']),
+                tuple(cpus['misc']),
+                tuple(tuple(n) for n in self.GetTotalNICsRequested()),
+                self.hugepages_gb)
+
     def SetTopMapType(self, t: str) -> None:
         if t == "NUMA":
             self.map_type = TopologyMapType.TOPOLOGY_MAP_NUMA
@@ -3,6 +3,8 @@ import os
 import datetime
 import random
 import string
+import threading
+import time
 from nhd.NHDCommon import NHDCommon
 from enum import Enum
 from colorlog import ColoredFormatter
@@ -10,13 +12,42 @@ from kubernetes import client, config, watch
 from kubernetes.client.rest import ApiException
 from nhd.Node import Node
 from typing import Dict, List, Set, Tuple
-import magicattr
-
+from collections import defaultdict
+from collections import OrderedDict
+from queue import Queue
+from queue import Empty
+from queue import Full
+
+
+CACHE_RELIST_INTERVAL_SEC   = 300 # Full relist of the pod/node caches as a safety net for missed watch events
+WATCH_TIMEOUT_SEC           = 60  # Server-side timeout of a single watch request before it's resumed
+WATCH_RETRY_SEC             = 5   # Time to wait before re-establishing a watch after an unexpected error
+EVENT_QUEUE_SIZE            = 1024 # Maximum events waiting to be sent before new ones are dropped
+EVENT_FOLD_CACHE_SIZE       = 4096 # Number of (pod, reason) pairs remembered for folding repeated events
+LIST_PAGE_SIZE              = 500 # Objects fetched per page when listing from the API server
+HUGEPAGE_NODE_QUERY_MAX     = 8   # Without the pod cache, hugepages for up to this many nodes are read with a per-node query
+ACTIVE_POD_SELECTOR         = 'status.phase!=Succeeded,status.phase!=Failed' # Finished pods hold no resources, so aren't cached
+CFGMAP_CACHE_SIZE           = 1024 # Number of ConfigMaps kept in the ConfigMap cache, evicting the least recently used
 
 class K8SEventType(Enum):
     EVENT_TYPE_NORMAL = 0
     EVENT_TYPE_WARNING = 1
 
+"""
+Snapshot of a single pod object. The pod is fetched once per scheduling attempt and shared across all of the K8SMgr
+helpers that need something from its spec, instead of each helper reading the pod again from the API server.
+"""
+class K8SPodSnapshot:
+    def __init__(self, pod: str, ns: str, obj):
+        self.name = pod
+        self.ns = ns
+        self.obj = obj
+
+    def Update(self, obj):
+        """ Replace the snapshot with a newer version of the pod, such as the response of a patch """
+        if obj is not None:
+            self.obj = obj
+
 """
 Helper class to communicate with Kubernetes API server. Assumes we are either running in a pod with
 proper permissions, or we have a KUBECONFIG file with cluster information.
@@ -47,121 +78,239 @@ class K8SMgr:
                 config.load_kube_config()
 
             self.v1 = client.CoreV1Api()
-            self.last_seen_ver = None
+
+            # Local caches kept current by the watch threads. Keys are (ns, name, uid) for pods and name for nodes
+            self.cache_lock = threading.Lock()
+            self.pod_cache = {}
+            self.sched_pods = defaultdict(dict) # Pods in the pod cache grouped by scheduler name, keyed the same way
+            self.node_cache = {}
+            self.pod_cache_ver = None
+            self.node_cache_ver = None
+            self.pod_relist_time = 0
+            self.node_relist_time = 0
+            self.watchers_started = False
+            self.listeners = [] # Callbacks run from the watch threads after the cache changes
+
+            # Hugepage usage per pod (node, pages), and the total used per node, kept in sync with the pod cache
+            self.pod_hugepages = {}
+            self.hugepage_used = defaultdict(int)
+
+            # ConfigMap contents keyed by (ns, name), holding (resourceVersion, key, data), in LRU order. Only used while
+            # the ConfigMap watch is running, since that's what evicts entries that were changed by someone else
+            self.cm_cache = OrderedDict()
+            self.cm_cache_ver = None
+            self.cm_relist_time = 0
+
+            # ConfigMaps being read from the API server, keyed by (ns, name), holding [readers, event number, resourceVersion]
+            # of the last watch event or relist seen while a read was outstanding. Used to keep results that were already
+            # out of date by the time they came back from going into the cache
+            self.cm_reads = {}
+            self.cm_events = 0
+
+            # Events are sent from their own thread to keep API round trips off the scheduling path
+            self.events = K8SEventEmitter(self.v1)
+            self.events.start()
 
             K8SMgr.__instance = self
 
-    def GetNodes(self):
-        """ Get the list of all currently-ready nodes """
-        nodes = []
+    def ListNodes(self) -> Dict:
+        """ Gets every node object keyed by name, from the node cache if it's running or a single list call if not """
         try: 
-            a = self.v1.list_node(watch=False)
-            for i in a.items:
-                for status in i.status.conditions:
-                    if status.status == "True" and status.type == "Ready":
-                        nodes.append(i.metadata.name)
+            if self.watchers_started:
+                with self.cache_lock:
+                    return dict(self.node_cache)
+
+            return {i.metadata.name: i for i in self.ListPaged(self.v1.list_node, {})}
         except ApiException as e:
             self.logger.error("Exception when calling CoreV1Api->list_node: %s\n" % e)
 
-        return nodes
-                
-    def GetNodeHugepageResources(self, node: str):
+        return {}
+
+    @staticmethod
+    def IsNodeReady(node) -> bool:
+        """ Checks the Ready condition of a node object """
+        for status in (node.status.conditions or []):
+            if status.status == "True" and status.type == "Ready":
+                return True
+
+        return False
+
+    @staticmethod
+    def HasNHDTaint(node) -> bool:
+        """ Checks a node object for the taint marking it as scheduled by NHD """
+        for t in (node.spec.taints or []):
+            if t.key == 'sigproc.viasat.io/nhd_scheduler' and t.effect == 'NoSchedule':
+                return True
+
+        return False
+
+    @staticmethod
+    def ParseHugepageGb(val: str) -> int:
+        """ Converts a 1Gi hugepage quantity string (e.g. '4Gi') into the number of pages """
+        return int(val[:val.find('G')])
+
+    @staticmethod
+    def GetPodHugepageUsage(pod):
         """
-        Pulls the hugepage resource information from a node (requests/allocatable)
+        Returns a (node, hugepages) tuple for the 1Gi hugepages a pod is consuming on its node, or None if the pod
+        isn't holding any hugepages on a node.
         """
-        try: 
-            a = self.v1.read_node(name = node)
-            alloc = int(a.status.allocatable['hugepages-1Gi'][:a.status.allocatable['hugepages-1Gi'].find('G')])
+        if pod.status is None or pod.status.phase not in ('Running', 'ContainerCreating', 'Pending'):
+            return None
 
-            # The actual amount of allocatable hugepages must be retrieved by iterating over each pod on this node
-            free = alloc
-            pods = self.v1.list_pod_for_all_namespaces(watch=False)
-            for i in pods.items:
-                if i.status.phase in ('Running', 'ContainerCreating', 'Pending'):
-                    if i.spec.node_name != node:
-                        continue
+        if pod.spec.node_name is None:
+            return None
 
-                    for c in i.spec.containers:
-                        if c.resources.requests and 'hugepages-1Gi' in c.resources.requests:
-                            free -= int(c.resources.requests['hugepages-1Gi'][:c.resources.requests['hugepages-1Gi'].find('G')])
+        used = 0
+        for c in pod.spec.containers:
+            if c.resources and c.resources.requests and 'hugepages-1Gi' in c.resources.requests:
+                used += K8SMgr.ParseHugepageGb(c.resources.requests['hugepages-1Gi'])
 
+        if used == 0:
+            return None
 
-            return (alloc, free)
+        return (pod.spec.node_name, used)
+
+    @staticmethod
+    def GroupHugepageUsage(pods, exclude: Dict[str, Set] = None) -> Dict[str, int]:
+        """ Groups the 1Gi hugepage requests of a list of pods by the node they're running on. Pods whose (pod, ns) is
+            in exclude[node] for their node are left out """
+        used = defaultdict(int)
+        for p in pods:
+            u = K8SMgr.GetPodHugepageUsage(p)
+            if u is not None and (p.metadata.name, p.metadata.namespace) not in (exclude or {}).get(u[0], ()):
+                used[u[0]] += u[1]
+
+        return used
+
+    def GetHugepageSnapshot(self, nodes: List[str], objs: Dict = None, exclude: Dict[str, Set] = None) -> Dict[str, Tuple[int, int]]:
+        """
+        Pulls the hugepage resource information (allocatable/free) for every node in the list in a single pass. When
+        the pod cache is running the per-node usage is maintained incrementally from watch events, so no list call is
+        needed at all. Otherwise the unfinished pods on each node are listed with a field selector when there are only
+        a few nodes, or all unfinished pods are listed once and grouped by node when there are more. If objs is given, it holds node objects
+        by name from ListNodes, and allocatable values are read from those rather than looking each node up. If exclude
+        is given, the usage of the (pod, ns) pairs in exclude[node] isn't counted against that node.
+        """
+        snap = {}
+        try:
+            if self.watchers_started:
+                with self.cache_lock:
+                    used = dict(self.hugepage_used)
+                    if exclude:
+                        for k,(n, pages) in self.pod_hugepages.items():
+                            if (k[1], k[0]) in exclude.get(n, ()):
+                                used[n] -= pages
+            elif len(nodes) <= HUGEPAGE_NODE_QUERY_MAX:
+                used = defaultdict(int)
+                for n in nodes:
+                    used.update(K8SMgr.GroupHugepageUsage(self.ListPaged(self.v1.list_pod_for_all_namespaces, {},
+                                                          field_selector=f'spec.nodeName={n},{ACTIVE_POD_SELECTOR}'), exclude))
+            else:
+                used = K8SMgr.GroupHugepageUsage(self.ListPaged(self.v1.list_pod_for_all_namespaces, {},
+                                                                field_selector=ACTIVE_POD_SELECTOR), exclude)
+
+            for n in nodes:
+                try:
+                    a = objs[n] if objs is not None else self.GetCachedNode(n)
+                    alloc = K8SMgr.ParseHugepageGb(a.status.allocatable['hugepages-1Gi'])
+                    snap[n] = (alloc, alloc - used.get(n, 0))
+                except ApiException as e:
+                    self.logger.error(f'Exception when reading node {n}: {e}')
+                    snap[n] = (0,0)
+                except Exception as e:
+                    self.logger.error(f'Non-API exception when getting hugepage information for node {n}: {e}')
+                    snap[n] = (0,0)
 
         except ApiException as e:
-            self.logger.error("Exception when calling CoreV1Api->list_node: %s\n" % e)
-        except Exception as e:
-            self.logger.error("Non-API exception when getting hugepage information")
-        
-        return (0,0)
+            self.logger.error("Exception when calling CoreV1Api->list_pod_for_all_namespaces: %s\n" % e)
+            return {n: (0,0) for n in nodes}
+
+        return snap
 
-    def GetNodeAttr(self, name, attr):
+    def GetPodSnapshot(self, pod: str, ns: str) -> K8SPodSnapshot:
         """
-        Get an attribute from a node. Useful for pulling things like nested data structures.
+        Fetches a pod once and returns a snapshot that can be passed to the other pod helpers. Returns None if the
+        pod can't be read.
         """
-        val = None
-        try: 
-            a = self.v1.read_node(name = name)
-            for status in a.status.conditions:
-                if status.status == "True" and status.type == "Ready":
-                    return magicattr.get(a, attr)
-
+        try:
+            return K8SPodSnapshot(pod, ns, self.v1.read_namespaced_pod(pod, ns))
         except ApiException as e:
-            self.logger.error("Exception when calling CoreV1Api->list_node: %s\n" % e)
+            self.logger.error(f'API exception when fetching namespaced pod: {ns}.{pod}')
 
-    def GetNodeAddr(self, name):
-        return self.GetNodeAttr(name, 'status.addresses[0].address')
+        return None
 
-    def GetNodeLabels(self, name):
-        return self.GetNodeAttr(name, 'metadata.labels')
+    def ReadPod(self, pod: str, ns: str, snap: K8SPodSnapshot = None):
+        """ Returns the pod object from a snapshot if we have one, otherwise reads it from the API server """
+        if snap is not None:
+            return snap.obj
 
-    def GetPodNode(self, pod, ns):
+        return self.v1.read_namespaced_pod(pod, ns)
+
+    def GetPodNode(self, pod, ns, snap: K8SPodSnapshot = None):
         """
         Get the node a pod resides on
         """
-        ret = self.v1.read_namespaced_pod(pod, ns)
+        try:
+            ret = self.ReadPod(pod, ns, snap)
+        except ApiException as e:
+            self.logger.error(f'API exception when fetching namespaced pod: {ns}.{pod}')
+            return None
+
         if ret == None:
             return None
         
         return ret.spec.node_name
 
-    def IsNHDTainted(self, node):
-        """
-        Find out if the node is tainted for NHD. Only tainted nodes will be used by NHD for scheduling, and also
-        ignored by the default scheduler.
+    def GetScheduledPods(self, sched_name):
         """
-        try: 
-            a = self.v1.read_node(name = node)        
-            taints = a.spec.taints
-            
-            for t in taints:
-                if t.key == 'sigproc.viasat.io/nhd_scheduler' and t.effect == 'NoSchedule':
-                    return True
+        Get all scheduled pods for a given scheduler
+        """        
+        return [(i.metadata.name, i.metadata.namespace, i.status.phase) for i in self.GetSchedulerPods(sched_name)]
 
-        except Exception:
-            return False
+    def GetSchedulerPods(self, sched_name) -> List:
+        """
+        Gets the pod objects of a given scheduler, from the pod cache if it's running. Otherwise the API server filters
+        on the scheduler name, so pods of other schedulers are never downloaded.
+        """
+        if self.watchers_started:
+            with self.cache_lock:
+                return list(self.sched_pods[sched_name].values())
 
-        return False
+        return list(self.ListPaged(self.v1.list_pod_for_all_namespaces, {}, field_selector=f'spec.schedulerName={sched_name}'))
 
-    def GetScheduledPods(self, sched_name):
+    def ListPaged(self, func, ver: Dict, **kwargs):
         """
-        Get all scheduled pods for a given scheduler
-        """        
-        ret = self.v1.list_pod_for_all_namespaces()
-        pods = []
+        Generator over every object of a list call, fetched LIST_PAGE_SIZE objects at a time so only one page is held
+        in memory. All pages come from the same snapshot, whose resourceVersion is stored in ver['resource_version']
+        """
+        cont = None
+        while True:
+            ret = func(limit=LIST_PAGE_SIZE, _continue=cont, **kwargs)
+            ver.setdefault('resource_version', ret.metadata.resource_version)
+            yield from ret.items
 
-        for i in ret.items:
-            if i.spec.scheduler_name == sched_name:
-                pods.append((i.metadata.name, i.metadata.namespace, i.status.phase))
+            cont = ret.metadata._continue
+            if not cont:
+                return
+
+    def GetPodVersions(self, sched_name) -> Dict[Tuple[str, str], Tuple]:
+        """
+        Gets (uid, resourceVersion, node, phase) for every pod of a given scheduler, keyed by (pod, ns)
+        """
+        pods = {}
+        for i in self.GetSchedulerPods(sched_name):
+            pods[(i.metadata.name, i.metadata.namespace)] = (i.metadata.uid, i.metadata.resource_version,
+                                                              i.spec.node_name, i.status.phase)
 
         return pods
 
-    def GetRequestedPodResources(self, pod: str, ns: str) -> Dict[str, str]:
+    def GetRequestedPodResources(self, pod: str, ns: str, snap: K8SPodSnapshot = None) -> Dict[str, str]:
         """
         Get the pod resources in dict format
         """        
         try: 
-            p = self.v1.read_namespaced_pod(pod, ns)
+            p = self.ReadPod(pod, ns, snap)
 
             # Only support one container per pod for now
             return p.spec.containers[0].resources.requests
@@ -173,71 +322,233 @@ class K8SMgr:
 
 
     def ServicePods(self, sched_name):
-        """ Check if a pod is waiting to be scheduled """
-        ret = self.v1.list_pod_for_all_namespaces()
+        """ Check if a pod is waiting to be scheduled. Reads from the local pod cache kept current by the watch
+            thread, so no list call is made against the API server here. Returns (phase, node, resourceVersion) for
+            every pod of the scheduler, keyed by (ns, pod, uid). """
         pods = {}
-        for i in ret.items:
-            if i.spec.scheduler_name != sched_name:
-                continue
+        with self.cache_lock:
+            for k,i in self.sched_pods[sched_name].items():
+                pods[k] = (i.status.phase, i.spec.node_name, i.metadata.resource_version)
 
-            pods[(i.metadata.namespace, i.metadata.name, i.metadata.uid)] = (i.status.phase, i.spec.node_name)
+        return pods
 
-#            if event['object'].status.phase == "Pending" and event['object'].spec.node_name is None:
-#                try:
-#                    pods.append((event['object'].metadata.name, event['object'].metadata.namespace, PodStatus.POD_STATUS_PENDING))
-#                except client.rest.ApiException as e:
-#                    self.logger.error(json.loads(e.body)['message'])                
-#
-#            elif event['object'].status.phase == "Failed":
-#                pods.append((event['object'].metadata.name, event['object'].metadata.namespace, PodStatus.POD_STATUS_FAILED))
+    def StartWatchers(self):
+        """
+        Populates the pod and node caches with a full list, and starts the background threads that keep them
+        current from the watch API. Events are only used to keep the cache fresh; a full relist is still done
+        every CACHE_RELIST_INTERVAL_SEC seconds so that missed or out-of-order events can't leave the cache
+        permanently out of sync with the cluster.
+        """
+        if self.watchers_started:
+            return
 
-        return pods
+        self.RelistPods()
+        self.RelistNodes()
+        self.RelistCfgMaps()
 
-    def FlushWatchQueue(self):
-        self.logger.info('Flushing watch queue')
-        w = watch.Watch()
-        if self.last_seen_ver == None:
-            e = w.stream(self.v1.list_pod_for_all_namespaces)
-        else:
-            e = w.stream(self.v1.list_pod_for_all_namespaces, resource_version=self.last_seen_ver)
-        
-        for event in e:
-            self.last_seen_ver = event['object'].metadata.resource_version
-
-
-#    def ServicePods(self, sched_name):
-        """ Switched to using a list of pods instead of watching """
-
-#        w = watch.Watch()
-#        if self.last_seen_ver == None:
-#            e = w.stream(self.v1.list_pod_for_all_namespaces)
-#        else:
-#            e = w.stream(self.v1.list_pod_for_all_namespaces, resource_version=self.last_seen_ver)
-#
-#        for event in e:
-#            self.last_seen_ver = event['object'].metadata.resource_version
-#            if event['object'].spec.scheduler_name != sched_name:
-#                continue
-#
-#            return (event['object'].metadata.name, 
-#                    event['object'].metadata.namespace, 
-#                    event['object'].status.phase, 
-#                    event['object'].spec.node_name,
-#                    event['type'])
-#        
-#        return None
-#                print(event['object'].status.phase, event['object'].metadata.name)
-#                if event['object'].status.phase == "Pending" and  event['object'].spec.node_name is None:
-#                    try:
-#                        self.logger.info(f"Received pod scheduling request for {event['object'].metadata.name}")
-#                        return event['object'].metadata.name
-#                    except client.rest.ApiException as e:
-#                        self.logger.error(json.loads(e.body)['message'])
-
-    def AddNADToPod(self, pod, ns, nads):
+        for target in (self.WatchPods, self.WatchNodes, self.WatchCfgMaps):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+
+        self.watchers_started = True
+
+    def AddEventListener(self, cb):
+        """
+        Registers a callback that's run after every change to the pod or node cache, as cb(kind, etype, obj). kind is
+        'pod' or 'node', and etype is the watch event type, or 'RELIST' (with obj set to None) after a full relist.
+        Callbacks run on the watch threads, so they should only hand the notification off.
+        """
+        self.listeners.append(cb)
+
+    def NotifyListeners(self, kind, etype, obj):
+        for cb in self.listeners:
+            try:
+                cb(kind, etype, obj)
+            except Exception as e:
+                self.logger.error(f'Exception in cache event listener: {e}')
+
+    def RelistPods(self):
+        """ Replaces the entire pod cache with a fresh list of all unfinished pods from the API server """
+        ver = {}
+        pods = {}
+        sched = defaultdict(dict)
+        huge = {}
+        for i in self.ListPaged(self.v1.list_pod_for_all_namespaces, ver, field_selector=ACTIVE_POD_SELECTOR):
+            k = (i.metadata.namespace, i.metadata.name, i.metadata.uid)
+            pods[k] = i
+            sched[i.spec.scheduler_name][k] = i
+            u = K8SMgr.GetPodHugepageUsage(i)
+            if u is not None:
+                huge[k] = u
+
+        with self.cache_lock:
+            self.pod_cache = pods
+            self.sched_pods = sched
+            self.pod_hugepages = huge
+            self.hugepage_used = defaultdict(int)
+            for u in huge.values():
+                self.hugepage_used[u[0]] += u[1]
+            self.pod_cache_ver = ver['resource_version']
+            self.pod_relist_time = time.time()
+
+        self.logger.info(f'Relisted {len(pods)} pods at resource version {self.pod_cache_ver}')
+        self.NotifyListeners('pod', 'RELIST', None)
+
+    def RelistNodes(self):
+        """ Replaces the entire node cache with a fresh list from the API server """
+        ver = {}
+        nodes = {}
+        for i in self.ListPaged(self.v1.list_node, ver):
+            nodes[i.metadata.name] = i
+
+        with self.cache_lock:
+            self.node_cache = nodes
+            self.node_cache_ver = ver['resource_version']
+            self.node_relist_time = time.time()
+
+        self.logger.info(f'Relisted {len(nodes)} nodes at resource version {self.node_cache_ver}')
+        self.NotifyListeners('node', 'RELIST', None)
+
+    def RelistCfgMaps(self):
+        """ Empties the ConfigMap cache, since changes may have been missed, and restarts the ConfigMap watch from the
+            current resourceVersion. Only a single ConfigMap is listed to get that version """
+        ret = self.v1.list_config_map_for_all_namespaces(limit=1)
+        with self.cache_lock:
+            self.cm_cache.clear()
+            self.cm_cache_ver = ret.metadata.resource_version
+            self.cm_relist_time = time.time()
+
+            # Reads still outstanding may have missed changes too
+            self.cm_events += 1
+            for r in self.cm_reads.values():
+                r[1:] = [self.cm_events, None]
+
+        self.logger.info(f'Cleared ConfigMap cache at resource version {self.cm_cache_ver}')
+
+    def ApplyPodEvent(self, etype, pod):
+        """ Applies a single watch event to the pod cache. Pods that finish stop matching the watch's field selector,
+            and arrive here as deleted. """
+        k = (pod.metadata.namespace, pod.metadata.name, pod.metadata.uid)
+        with self.cache_lock:
+            if etype == 'DELETED':
+                self.pod_cache.pop(k, None)
+                self.sched_pods[pod.spec.scheduler_name].pop(k, None)
+
+                # Deleted pods may be recreated with the same name and a fresh config, so don't keep its ConfigMap
+                cm = K8SMgr.GetPodCfgMapName(pod)
+                if cm is not None:
+                    self.cm_cache.pop((pod.metadata.namespace, cm), None)
+            else:
+                self.pod_cache[k] = pod
+                self.sched_pods[pod.spec.scheduler_name][k] = pod
+
+            # Move this pod's hugepage usage over to whatever it is after the event. Pods binding to a node add
+            # usage, and pods terminating or being deleted give it back.
+            old = self.pod_hugepages.pop(k, None)
+            if old is not None:
+                self.hugepage_used[old[0]] -= old[1]
+
+            new = K8SMgr.GetPodHugepageUsage(pod) if etype != 'DELETED' else None
+            if new is not None:
+                self.pod_hugepages[k] = new
+                self.hugepage_used[new[0]] += new[1]
+
+            self.pod_cache_ver = pod.metadata.resource_version
+
+        self.NotifyListeners('pod', etype, pod)
+
+    def ApplyNodeEvent(self, etype, node):
+        """ Applies a single watch event to the node cache """
+        with self.cache_lock:
+            if etype == 'DELETED':
+                self.node_cache.pop(node.metadata.name, None)
+            else:
+                self.node_cache[node.metadata.name] = node
+
+            self.node_cache_ver = node.metadata.resource_version
+
+        self.NotifyListeners('node', etype, node)
+
+    def ApplyCfgMapEvent(self, etype, cm):
+        """ Evicts a cached ConfigMap once it's changed or deleted. A change whose resourceVersion matches the cached
+            entry is NHD's own patch, which is already cached. Events for ConfigMaps being read are recorded against the
+            read, since they may arrive before its result is cached """
+        k = (cm.metadata.namespace, cm.metadata.name)
+        with self.cache_lock:
+            if k in self.cm_cache and (etype == 'DELETED' or self.cm_cache[k][0] != cm.metadata.resource_version):
+                del self.cm_cache[k]
+
+            self.cm_events += 1
+            if k in self.cm_reads:
+                self.cm_reads[k][1:] = [self.cm_events, cm.metadata.resource_version if etype != 'DELETED' else None]
+
+            self.cm_cache_ver = cm.metadata.resource_version
+
+    def RunWatch(self, listfunc, relist, apply, getver, gettime, **kwargs):
+        """
+        Generic watch loop used for both pods and nodes. The watch resumes from the last resource version seen,
+        and falls back to a full relist if the version has expired (HTTP 410), the stream errors, or the
+        periodic relist interval has passed. Any extra arguments, such as a field selector, are passed to the watch
+        and must match the ones the relist uses.
+        """
+        while True:
+            try:
+                if time.time() - gettime() > CACHE_RELIST_INTERVAL_SEC:
+                    relist()
+
+                w = watch.Watch()
+                for event in w.stream(listfunc, resource_version=getver(), timeout_seconds=WATCH_TIMEOUT_SEC, **kwargs):
+                    if event['type'] == 'ERROR':
+                        self.logger.warning(f'Received error event from watch: {event["raw_object"]}. Relisting')
+                        relist()
+                        break
+
+                    if event['type'] in ('ADDED', 'MODIFIED', 'DELETED'):
+                        apply(event['type'], event['object'])
+
+            except ApiException as e:
+                if e.status == 410:
+                    self.logger.info('Watch resource version expired. Relisting')
+                else:
+                    self.logger.error(f'Exception while watching: {e}. Relisting')
+                    time.sleep(WATCH_RETRY_SEC)
+
+                try:
+                    relist()
+                except Exception as e:
+                    self.logger.error(f'Failed to relist after watch error: {e}')
+
+            except Exception as e:
+                self.logger.error(f'Non-API exception while watching: {e}')
+                time.sleep(WATCH_RETRY_SEC)
+
+    def WatchPods(self):
+        """ Keeps the pod cache current from the watch API """
+        self.RunWatch(self.v1.list_pod_for_all_namespaces, self.RelistPods, self.ApplyPodEvent,
+                      lambda: self.pod_cache_ver, lambda: self.pod_relist_time, field_selector=ACTIVE_POD_SELECTOR)
+
+    def WatchNodes(self):
+        """ Keeps the node cache current from the watch API """
+        self.RunWatch(self.v1.list_node, self.RelistNodes, self.ApplyNodeEvent,
+                      lambda: self.node_cache_ver, lambda: self.node_relist_time)
+
+    def WatchCfgMaps(self):
+        """ Keeps the ConfigMap cache from serving stale configs """
+        self.RunWatch(self.v1.list_config_map_for_all_namespaces, self.RelistCfgMaps, self.ApplyCfgMapEvent,
+                      lambda: self.cm_cache_ver, lambda: self.cm_relist_time)
+
+    def GetCachedNode(self, name):
+        """ Gets a node object from the node cache, or from the API server if the cache isn't running """
+        with self.cache_lock:
+            if name in self.node_cache:
+                return self.node_cache[name]
+
+        return self.v1.read_node(name = name)
+
+    def AddNADToPod(self, pod, ns, nads, snap: K8SPodSnapshot = None):
         """ Adds network attachment definitions to bind to pod """
         try:
-            self.v1.patch_namespaced_pod(pod, ns, body= {
+            ret = self.v1.patch_namespaced_pod(pod, ns, body= {
                 "metadata": {
                     "annotations": {
                         "k8s.v1.cni.cncf.io/networks": nads
@@ -248,9 +559,13 @@ class K8SMgr:
             self.logger.error(f'Failed to update pod metadata NAD {pod} in namespace {ns}')
             return False
 
+        # The patch bumps the pod's resourceVersion, so keep the snapshot current for any later replace
+        if snap is not None:
+            snap.Update(ret)
+
         return True
 
-    def AddSRIOVDevice(self, pod, ns, device, num):
+    def AddSRIOVDevice(self, pod, ns, device, num, snap: K8SPodSnapshot = None):
         """ Adds an SR-IOV device using the SR-IOV plugin. Only adds to the first container. Unfortunately Kubernetes
             does not allow you to patch resources of a pod, so we must replace the container. """
         self.logger.info(f'Adding {num} SR-IOV device{"s" if num > 0 else ""} {device} to pod {ns}.{pod}')
@@ -259,7 +574,7 @@ class K8SMgr:
         # To fix this, but it's still not available yet: 
         # https://github.com/kubernetes/community/pull/2908/commits/4ad6fa7c27f4a21c27a6be83c2dc81c43549fa55
         try:
-            p = self.v1.read_namespaced_pod(pod, ns)
+            p = self.ReadPod(pod, ns, snap)
         except ApiException as e:
             self.logger.error(f'Failed to get pod spec {pod} in namespace {ns}')
             return False
@@ -269,55 +584,125 @@ class K8SMgr:
         p.spec.containers[0].resources.requests[f'intel.com/{device}'] = f'{num}'
         
         try:
-            self.v1.replace_namespaced_pod(pod, ns, body=p)
+            ret = self.v1.replace_namespaced_pod(pod, ns, body=p)
         except ApiException as e:
             self.logger.error(f'Failed to replace pod spec {pod} in namespace {ns}')
             print(e)
             return False
 
+        if snap is not None:
+            snap.Update(ret)
+
         self.logger.info(f'Added SR-IOV device into pod {pod}')
         return True
 
 
-    def GetCfgMap(self, pod, ns):
+    @staticmethod
+    def GetPodCfgMapName(p):
+        """ Gets the name of the first ConfigMap volume in a pod object """
+        for v in p.spec.volumes or []:
+            if v.config_map:
+                return v.config_map.name
+
+        return None
+
+    def GetCfgMap(self, pod, ns, snap: K8SPodSnapshot = None):
         """
         Gets the first configmap from an existing pod
         """
-        ret = self.v1.list_namespaced_pod(watch=False, namespace=ns)
-        for i in ret.items:
-            if i.metadata.name != pod: # Only look at container that use the run command
-                continue
-            
-            cm = None
-            for v in i.spec.volumes:
-                if v.config_map:
-                   cm = v.config_map.name
-                   break
-
-            if cm:
-                self.logger.info(f'Found ConfigMap {cm} for pod {pod}')
-                cmdat = self.v1.list_namespaced_config_map(ns)
-                for c in cmdat.items:
-                    if c.metadata.name != cm:
-                        continue
-
-                    self.logger.info(f'Successfully looked up ConfigMap {cm}')
-                    for cname, cval in c.data.items():
-                        self.logger.info(f'Returning ConfigMap for file {cname}')
-                        return (cm, cval)
-            else:
-                self.logger.error(f'No ConfigMap found for pod {pod}')
-                return (None,None)
+        try:
+            p = self.ReadPod(pod, ns, snap)
+        except ApiException as e:
+            self.logger.error(f'API exception when fetching namespaced pod: {ns}.{pod}')
+            return (None,None)
 
+        cm = K8SMgr.GetPodCfgMapName(p)
+        if not cm:
+            self.logger.error(f'No ConfigMap found for pod {pod}')
+            return (None,None)
+
+        self.logger.info(f'Found ConfigMap {cm} for pod {pod}')
+        return self.ReadCfgMap(ns, cm)
+
+    def ReadCfgMap(self, ns, cm):
+        """
+        Reads the contents of a ConfigMap. While the watchers are running, ConfigMaps are cached by (namespace, name)
+        along with the resourceVersion they were read at, so repeated lookups of a config that hasn't changed don't go
+        to the API server. Entries are refreshed when NHD patches the ConfigMap, evicted by the ConfigMap watch when
+        anything else changes it, and dropped when the pod using it is deleted.
+        """
+        with self.cache_lock:
+            if self.watchers_started and (ns, cm) in self.cm_cache:
+                self.cm_cache.move_to_end((ns, cm))
+                (_, cname, cval) = self.cm_cache[(ns, cm)]
+                self.logger.info(f'Returning cached ConfigMap {cm} for file {cname}')
+                return (cm, cval)
+
+        since = self.StartCfgMapRead(ns, cm)
+        try:
+            c = self.v1.read_namespaced_config_map(name=cm, namespace=ns)
+        except ApiException as e:
+            self.logger.error(f'API exception when fetching ConfigMap: {ns}.{cm}')
+            self.FinishCfgMapRead(ns, cm, since)
+            return (None,None)
+
+        self.logger.info(f'Successfully looked up ConfigMap {cm}')
+        for cname, cval in (c.data or {}).items():
+            self.logger.info(f'Returning ConfigMap for file {cname}')
+            self.FinishCfgMapRead(ns, cm, since, c.metadata.resource_version, cname, cval)
+            return (cm, cval)
+
+        self.FinishCfgMapRead(ns, cm, since)
         return (None,None)
 
+    def StartCfgMapRead(self, ns, cm) -> int:
+        """ Registers a read or write of a ConfigMap that's about to go to the API server. Returns the event number to
+            pass to FinishCfgMapRead once it's done """
+        with self.cache_lock:
+            self.cm_reads.setdefault((ns, cm), [0, 0, None])[0] += 1
+            return self.cm_events
+
+    def FinishCfgMapRead(self, ns, cm, since, ver=None, key=None, data=None):
+        """
+        Completes a ConfigMap read started at event number `since`, adding its result to the cache and evicting the least
+        recently used entry if it's full. Leave out the data if the read failed. If the watch saw the ConfigMap change
+        since the read started, the result may be older than that change, and caching it would serve stale data until
+        the next one. It's only kept if the last change seen is the version that was read.
+        """
+        k = (ns, cm)
+        with self.cache_lock:
+            r = self.cm_reads[k]
+            r[0] -= 1
+            if r[0] == 0:
+                del self.cm_reads[k]
+
+            if data is None or not self.watchers_started or (r[1] > since and r[2] != ver):
+                return
+
+            self.cm_cache[(ns, cm)] = (ver, key, data)
+            self.cm_cache.move_to_end((ns, cm))
+            if len(self.cm_cache) > CFGMAP_CACHE_SIZE:
+                self.cm_cache.popitem(last=False)
+
+    def InvalidateCfgMap(self, ns, cm):
+        """ Drops a ConfigMap from the cache so the next lookup is read from the API server """
+        with self.cache_lock:
+            self.cm_cache.pop((ns, cm), None)
 
     def ReplaceConfigMap(self, ns, cmname, cmbody):
         """ Replaces a ConfigMap object with a new value """
 
+        since = self.StartCfgMapRead(ns, cmname)
         try:
-            resp = self.v1.read_namespaced_config_map(name=cmname, namespace=ns)
-            keyname = list(resp.data.keys())[0]
+            with self.cache_lock:
+                cached = self.cm_cache.get((ns, cmname))
+
+            if cached is not None:
+                keyname = cached[1]
+            else:
+                resp = self.v1.read_namespaced_config_map(name=cmname, namespace=ns)
+                keyname = list(resp.data.keys())[0]
+
             tmp_map = {
                 "kind": "ConfigMap",
                 "apiVersion": "v1",
@@ -329,15 +714,57 @@ class K8SMgr:
                 }
             }
 
-            tmpdict = vars(resp)
             ret = self.v1.patch_namespaced_config_map(name=cmname, namespace=ns, body=tmp_map)
 
         except ApiException as e:
             self.logger.error(f'Failed to replace configmap {cmname} in namespace {ns}')
+            self.FinishCfgMapRead(ns, cmname, since)
+            self.InvalidateCfgMap(ns, cmname)
+            return False
+
+        # Keep the cache in sync with what we just wrote
+        self.FinishCfgMapRead(ns, cmname, since, ret.metadata.resource_version, keyname, cmbody)
+
+        return True
+
+    def ReadConfigMapKey(self, ns, cmname, key) -> str:
+        """ Reads a single key from a ConfigMap. Returns None if the ConfigMap or key doesn't exist """
+        try:
+            resp = self.v1.read_namespaced_config_map(name=cmname, namespace=ns)
+        except ApiException as e:
+            if e.status != 404:
+                self.logger.error(f'API exception when fetching ConfigMap: {ns}.{cmname}')
+            return None
+
+        return (resp.data or {}).get(key)
+
+    def WriteConfigMapKey(self, ns, cmname, key, value) -> bool:
+        """ Writes a single key of a ConfigMap, creating the ConfigMap if it doesn't exist """
+        body = {
+            "kind": "ConfigMap",
+            "apiVersion": "v1",
+            "metadata": {
+                "name": cmname,
+            },
+            "data": {
+                key: value
+            }
+        }
+
+        try:
+            try:
+                self.v1.replace_namespaced_config_map(name=cmname, namespace=ns, body=body)
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+
+                self.v1.create_namespaced_config_map(namespace=ns, body=body)
+
+        except ApiException as e:
+            self.logger.error(f'Failed to write configmap {cmname} in namespace {ns}')
             return False
 
         return True
-                
 
     def BindPodToNode(self, podname, node, ns):
         """ Binds a pod to a node to start the deployment process. """
@@ -365,12 +792,12 @@ class K8SMgr:
 
         return True
 
-    def GetCfgType(self, pod: str, ns: str) -> str:
+    def GetCfgType(self, pod: str, ns: str, snap: K8SPodSnapshot = None) -> str:
         """
         Gets the configuration type from the pod's annotations
         """
         try:
-            ret = self.v1.read_namespaced_pod(pod, ns)
+            ret = self.ReadPod(pod, ns, snap)
             # Verify all annotations are present
             ann = ret.metadata.annotations     
             return ann['sigproc.viasat.io/cfg_type']   
@@ -381,16 +808,107 @@ class K8SMgr:
             self.logger.error(f'API exception when fetching namespaced pod: {ns}.{pod}')
             return ''
 
+    def GetPodAnnotation(self, pod: str, ns: str, key: str, snap: K8SPodSnapshot = None) -> str:
+        """
+        Gets an optional annotation from the pod. Returns an empty string if the pod doesn't have it
+        """
+        try:
+            ret = self.ReadPod(pod, ns, snap)
+            ann = ret.metadata.annotations or {}
+            return ann.get(key, '')
+        except ApiException as e:
+            self.logger.error(f'API exception when fetching namespaced pod: {ns}.{pod}')
+            return ''
+
     def GetTimeNow(self) -> str:
         """ Uses Kubernetes undocumented format. Any deviation from this will throw an error at the API server """
         return datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
 
+    def GeneratePodEvent(self, podname, ns, reason, _type, message):
+        """ Generates a pod event on the kubernetes API server. The event is logged here, but sent to the API server
+            by the background event emitter so the scheduling path never waits on it. """
+        if _type == K8SEventType.EVENT_TYPE_NORMAL:
+            etype = "Normal"
+            lg = self.logger.info
+        else:
+            etype = "Warning"
+            lg = self.logger.warning
+
+        # Log an event in our pod too instead of duplicating externally
+        lg(f'Event for pod {ns}/{podname} -- Reason={reason}, message={message}')
+
+        self.events.Post(podname, ns, reason, etype, message, self.GetTimeNow())
+
+"""
+Sends Kubernetes events from a background thread. Events are queued on a bounded queue so that sending them never
+blocks scheduling; if the queue fills up, new events are dropped. Repeated events with the same reason for the same
+pod are folded into a single Kubernetes event with an increasing count, the same way the kubelet does it.
+"""
+class K8SEventEmitter(threading.Thread):
+    def __init__(self, v1):
+        threading.Thread.__init__(self, daemon=True)
+        self.logger = NHDCommon.GetLogger(__name__)
+        self.v1 = v1
+        self.q = Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.sent = OrderedDict() # (ns, pod, reason) -> (event name, count), in LRU order
+        self.dropped = 0
+
+    def Post(self, podname, ns, reason, etype, message, timestamp):
+        """ Queues an event to be sent. Never blocks """
+        try:
+            self.q.put_nowait((podname, ns, reason, etype, message, timestamp))
+        except Full:
+            self.dropped += 1
+            self.logger.debug(f'Event queue full, dropping event {reason} for pod {ns}/{podname} ({self.dropped} dropped)')
+
     def GetRandomUid(self) -> str:
         return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(15))
 
-    def GeneratePodEvent(self, podname, ns, reason, _type, message):
-        """ Generates a pod event on the kubernetes API server """
+    def run(self):
+        while True:
+            batch = [self.q.get()]
+            try:
+                while True:
+                    batch.append(self.q.get_nowait())
+            except Empty:
+                pass
+
+            # Fold duplicates inside the batch before going to the API server
+            folded = OrderedDict()
+            for (podname, ns, reason, etype, message, timestamp) in batch:
+                k = (ns, podname, reason)
+                if k in folded:
+                    folded[k][2] = message
+                    folded[k][4] = timestamp
+                    folded[k][5] += 1
+                else:
+                    folded[k] = [podname, etype, message, timestamp, timestamp, 1]
+
+            for k, (podname, etype, message, first, last, num) in folded.items():
+                self.Send(k[0], podname, k[2], etype, message, first, last, num)
+
+    def Send(self, ns, podname, reason, etype, message, first, last, num):
+        """ Sends a single (possibly folded) event, either as a new event or as a count update to an existing one """
+        k = (ns, podname, reason)
         try:
+            if k in self.sent:
+                name, count = self.sent[k]
+                self.sent.move_to_end(k)
+                try:
+                    self.v1.patch_namespaced_event(name, ns, body={
+                        "count": count + num,
+                        "lastTimestamp": last,
+                        "message": f'NHD: {message}'
+                    })
+                    self.sent[k] = (name, count + num)
+                    return
+                except ApiException as e:
+                    if e.status != 404:
+                        raise
+
+                    # The original event expired on the API server. Start a new one
+                    del self.sent[k]
+
             meta  = client.V1ObjectMeta()
             meta.name = f'{podname}.{self.GetRandomUid()}'
             meta.namespace = ns
@@ -399,26 +917,17 @@ class K8SMgr:
             invobj.name = podname
             invobj.kind = "Pod"
             invobj.namespace = ns
-            #invobj.uid = ruid
-
-
-            if _type == K8SEventType.EVENT_TYPE_NORMAL:
-                etype = "Normal"
-                lg = self.logger.info
-            else:
-                etype = "Warning"
-                lg = self.logger.warning
 
-            timestamp = self.GetTimeNow()
-
-
-            # Log an event in our pod too instead of duplicating externally
-            lg(f'Event for pod {ns}/{podname} -- Reason={reason}, message={message}')
-            event = client.V1Event(involved_object=invobj, metadata=meta, reason=reason, message=f'NHD: {message}', count=1, type=etype, first_timestamp=timestamp, last_timestamp=timestamp)
+            event = client.V1Event(involved_object=invobj, metadata=meta, reason=reason, message=f'NHD: {message}', count=num, type=etype, first_timestamp=first, last_timestamp=last)
 
             self.v1.create_namespaced_event(namespace=ns, body=event)
 
+            self.sent[k] = (meta.name, num)
+            if len(self.sent) > EVENT_FOLD_CACHE_SIZE:
+                self.sent.popitem(last=False)
+
         except ApiException as e:
             self.logger.error(f'Failed to send event for pod {podname}: {e}')
-
+        except Exception as e:
+            self.logger.error(f'Non-API exception when sending event for pod {podname}: {e}')
 
@@ -1,16 +1,25 @@
 import logging
-import copy
-import itertools
 import math
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from colorlog import ColoredFormatter
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from nhd.Node import Node
+from nhd.Node import NodeFreeState
 from nhd.NHDCommon import NHDCommon
 from nhd.CfgTopology import SMTSetting
 from nhd.CfgTopology import TopologyMapType
 from nhd.CfgTopology import CfgTopology
-from typing import Dict
+from nhd.NumaSolver import NumaSolver
+from nhd.NodeScorer import NodeScorer
+from typing import Dict, List
+
+MAX_NUMA_COMBOS             = 64                    # Stop searching a node after this many valid NUMA mappings have been found
+FILTER_WORKERS_ENV          = 'NHD_FILTER_WORKERS'  # Environment variable setting the number of node filtering processes
+DEFAULT_FILTER_WORKERS      = 0                     # Filter nodes serially unless configured otherwise
+PARALLEL_FILTER_MIN_NODES   = 32                    # Below this many nodes the pool overhead outweighs the gain, so filter serially
+FILTER_CACHE_SIZE           = 4096                  # Number of per-node filter results kept for reuse by pods with the same request
 
 
 """
@@ -21,11 +30,24 @@ class Matcher:
     def __init__(self):
         self.logger = NHDCommon.GetLogger(__name__)
         self.logger.info('Initializing matcher')
+        self.scorer = NodeScorer()
+        self.pool = None
+        self.filter_cache: OrderedDict = OrderedDict() # (request shape, node, state version) -> FilterNodeState result, in LRU order
+
+        try:
+            self.workers = int(os.environ.get(FILTER_WORKERS_ENV, DEFAULT_FILTER_WORKERS))
+        except ValueError:
+            self.logger.warning(f'Invalid {FILTER_WORKERS_ENV} value. Filtering nodes serially')
+            self.workers = 0
 
+        if self.workers > 1:
+            self.logger.info(f'Filtering nodes with {self.workers} worker processes on clusters of {PARALLEL_FILTER_MIN_NODES} nodes or more')
 
-    def FindNode(self, nl, top) -> str:
+
+    def FindNode(self, nl, top, strategy: str = None) -> str:
         """ Main scheduling matcher function. Attempts to find the best node match based on a list of
-        available nodes, plus the pod's topology configuration. For algorithm details, see GitHub """
+        available nodes, plus the pod's topology configuration. strategy is the name of the scoring strategy
+        the pod asked for, or None for the deployment default. For algorithm details, see GitHub """
 
         self.logger.info(f'Attempting to find node for pod with {len(top.proc_groups)} process groups, '
                         f'{len(top.misc_cores)} misc cores')
@@ -41,14 +63,11 @@ class Matcher:
                 self.logger.info('No candidate nodes found after filter step!')
                 return (None,)
             
-            self.logger.info(f'{len(filts[1])} candidate nodes found after filtering. Intersecting resources...')
-            isect = self.IntersectNumaResources(filts)
-            node = self.SelectNode(filts)
+            self.logger.info(f'{len(filts[1])} candidate nodes found after filtering. Selecting node...')
+            node, midx = self.SelectNode(nl, filts, self.scorer.GetStrategy(strategy))
             if node == '':
-                self.logger.error('NUMA intersection step left no candidate nodes. Cannot schedule pod!')
+                self.logger.error('NUMA matching step left no candidate nodes. Cannot schedule pod!')
                 return (None,)
-                
-            midx = self.GetNumaGroupIdx(node, nl[node].numa_nodes, filts)
 
             return node, midx
         elif top.map_type == TopologyMapType.TOPOLOGY_MAP_PCI:
@@ -76,292 +95,151 @@ class Matcher:
         return filtnodes
 
 
-    def FilterNumaTopology(self, nl, top):
-        """ Match nodes based on NUMA topology. The only criteria here is that the GPUs, CPUs, and NICs fall
-            on the same NUMA node for a given processing group. Each predicate filter step is intentionally
-            not combined with others for ease of debugging. """
+    @staticmethod
+    def GetNumaCpuRequest(smt: bool, req_cpus) -> List[int]:
+        """ Converts the requested CPUs into the number of physical cores needed per group on a node with or without
+            SMT enabled. The last entry holds the top-level miscellaneous cores. """
+        clist = []
 
-        cand_nodes = list(nl.keys())
-        to_drop = []
-        res_cands  = {}
+        # Since we treat the helper and processors cores as a separate entity that we don't necessarily want on the same SMT
+        # siblings, we need to add them in separate groups
+        for t in req_cpus['proc']:
+            if smt:
+                tot = 0
+                if t[0][1].value: # SMT enabled
+                    tot += int(math.ceil(t[0][0]/2.0))
+                else:       # SMT disabled
+                    tot += t[0][0]
 
-        # First check if there's enough GPUs free. The amount returned from the topology is per group, meaning
-        # that if two GPUs are in the same group they must be scheduled on the same NUMA node.
-        self.logger.info('Gathering data about GPU requests')
-        req_gpus = top.GetTotalGpusRequested()
+                if t[1][1].value: # SMT enabled
+                    tot += int(math.ceil(t[1][0]/2.0))
+                else:       # SMT disabled
+                    tot += t[1][0]
 
-        gpu_cands = {}
-        for n,v in nl.items():
-            stmp = set()
-            self.logger.info(f'Checking node {n} for enough free GPUs')
-            free_gpus = v.GetFreeNumaGPUs()
-
-            # Make a list of all ways the GPUs can be assigned to NUMA nodes
-            pr = list(itertools.product(range(v.numa_nodes), repeat=len(req_gpus)))
-            for p in pr: # combination
-                ttl = [0] * v.numa_nodes # Hold the totals for this round to see if it passes
-                for idx,r in enumerate(p): # numa index
-                    ttl[r] += req_gpus[idx]
-
-                # Check to see if this combo would work
-                if all([ttl[xidx] <= free_gpus[xidx] for xidx in range(len(ttl))]):
-                    self.logger.debug(f'Found a valid mapping of {ttl} with free GPUs {free_gpus}')
-                    stmp.add(p)
-
-            # Check if there are enough free GPUs
-            if len(stmp) == 0:
-                self.logger.info(f'Dropping node {n} from candidate list since not enough free GPUs (req={req_gpus}, free={free_gpus})')
-                cand_nodes.remove(n)
+                clist.append(tot)
             else:
-                self.logger.info(f'Node {n} has {len(stmp)} possible GPU combinations to service request of {req_gpus}')
+                clist.append(t[0][0] + t[1][0])
 
-            gpu_cands[n] = list(stmp)
-    
-        if len(cand_nodes) > 0:
-            self.logger.info(f'{len(cand_nodes)} nodes found with sufficient GPU resources')
+        # Misc cores
+        if smt:
+            tot = int(math.ceil(req_cpus['misc'][0]/2.0)) if req_cpus['misc'][1] else req_cpus['misc'][0]
+            clist.append(tot)
         else:
-            self.logger.info(f'No nodes found with sufficient GPU resources. Pod will remain unscheduled')
-            return (None, None)
+            clist.append(req_cpus['misc'][0])
 
-        res_cands['gpu'] = gpu_cands
+        return clist
 
+    def FilterNumaTopology(self, nl, top):
+        """ Match nodes based on NUMA topology. The only criteria here is that the GPUs, CPUs, and NICs fall
+            on the same NUMA node for a given processing group. Each resource type is first checked on its own so
+            the reason a node was dropped is easy to debug, then a single search over group NUMA assignments checks
+            all three together.
 
-        # We now have available and requested CPUs in a format we can use. Finding pairings here is quite a bit more complicated
-        # than in the GPU case, since SMT creates many more variants than there would be without it. If the topology request
-        # allows SMT, we should prefer that over separate cores since it uses fewer resources and allows better packing for
-        # future requests.
-        fcpu = {}
-        cpu_cands = {}
+            Returns a tuple of (candidate combinations per node, candidate node list, free resources per node), where
+            each combination is a dict of the GPU, CPU and NIC mappings for one way of placing the pod on that node. The
+            free resources are kept so the scoring stage doesn't have to gather them again. """
 
-        self.logger.info('Gathering data about CPU requests')
+        cand_nodes = list(nl.keys())
+        res_cands  = {}
+        free       = {}
+
+        # GPUs are requested per group, meaning that if two GPUs are in the same group they must be scheduled on
+        # the same NUMA node. CPUs have more variants than GPUs since SMT changes how many physical cores a group
+        # needs. NICs are considered available if the requested speeds fit on interfaces on the same NUMA node as
+        # the group, and we need to match both RX and TX since the demand on them may not be symmetric.
+        req_gpus = top.GetTotalGpusRequested()
         req_cpus = top.GetTotalCpusRequested()
-        self.logger.info(f'Requested CPUs={req_cpus}')
-        
-        for n,v in nl.items():
-            fcpu[n] = v.GetFreeCpuCores()
-
-        #self.logger.info(f'Free request={freereq}')
-        self.logger.info(f'Free node CPUs={fcpu}')
-      
-        for n,v in nl.items():
-            if n not in cand_nodes:
-                self.logger.info(f'Not checking node {n} for CPUs since it\'s already excluded')
-                continue
+        req_nics = top.GetTotalNICsRequested()
+        self.logger.info(f'Requested GPUs={req_gpus}, CPUs={req_cpus}, NICs={req_nics}')
 
-            clist = []
-            stmp = set()
-
-            # Since we treat the helper and processors cores as a separate entity that we don't necessarily want on the same SMT
-            # siblings, we need to add them in separate groups
-            for t in req_cpus['proc']:
-                if v.SMTEnabled():
-                    tot = 0
-                    if t[0][1].value: # SMT enabled
-                        tot += int(math.ceil(t[0][0]/2.0))
-                    else:       # SMT disabled
-                        tot += t[0][0]
-
-                    if t[1][1].value: # SMT enabled
-                        tot += int(math.ceil(t[1][0]/2.0))
-                    else:       # SMT disabled
-                        tot += t[1][0]
-
-                    clist.append(tot)
-                else:
-                    clist.append(t[0][0] + t[1][0])
-
-            # Misc cores
-            if v.SMTEnabled():
-                tot = int(math.ceil(req_cpus['misc'][0]/2.0)) if req_cpus['misc'][1] else req_cpus['misc'][0]
-                clist.append(tot)
-            else:
-                clist.append(req_cpus['misc'][0])
-
-            pr = list(itertools.product(range(v.numa_nodes), repeat=len(clist)))
-            for p in pr: # combination
-                ttl = [0] * v.numa_nodes # Hold the totals for this round to see if it passes
-                for idx,r in enumerate(p): # numa index
-                    ttl[r] += clist[idx]
-                
-                # Check to see if this combo would work
-                if all([ttl[xidx] <= fcpu[n][xidx] for xidx in range(len(ttl))]):
-                    self.logger.debug(f'Found a valid mapping of {ttl} with free CPUs {fcpu[n]} where node has SMT={v.SMTEnabled()}')
-                    stmp.add(p)
-
-            if len(stmp) == 0:
-                self.logger.info(f'Dropping node {n} from candidate list since not enough free CPU cores (req={clist}, free={fcpu[n]})')
-                cand_nodes.remove(n)
+        # Replicas of the same workload send the same request, so only nodes that changed since a pod with this shape
+        # was last filtered need to be searched again
+        shape = top.GetRequestShape()
+        results = {}
+        states = []
+        for k,v in nl.items():
+            key = (shape, k, v.state_version)
+            if key in self.filter_cache:
+                self.filter_cache.move_to_end(key)
+                results[k] = self.filter_cache[key]
             else:
-                self.logger.info(f'Node {n} has {len(stmp)} possible CPU combinations to service request of {clist}')
+                states.append(v.GetFreeState())
 
-            cpu_cands[n] = list(stmp)
+        self.logger.info(f'Reusing filter results for {len(results)} nodes, searching {len(states)} nodes')
 
-        res_cands['cpu'] = cpu_cands
-            
-        # And finally, the NIC availability. NICs are considered available if the total speeds requested is available across
-        # all known interfaces in the system. This also must satisfy NUMA constraints, if any. We need to do matching on both
-        # RX and TX since the demand on them may not be symmetric. Note that NICs have an extra level of searching beyond what
-        # GPUs and CPUs did, since we can potentially have many NICs across many NUMA nodes with different speeds. This makes
-        # the matching constraints not just on NUMA nodes, but available interface speeds as well.
-        self.logger.info('Verifying nodes have the NIC resources available')
+        if self.workers > 1 and len(states) >= PARALLEL_FILTER_MIN_NODES:
+            chunk = max(1, len(states) // (self.workers * 4))
+            found = self.GetPool().map(Matcher.FilterNodeState, states, [req_gpus] * len(states), [req_cpus] * len(states),
+                                       [req_nics] * len(states), chunksize=chunk)
+        else:
+            found = (self.FilterNodeState(st, req_gpus, req_cpus, req_nics) for st in states)
 
-        req_nics = top.GetTotalNICsRequested()
-        nnic_free = {} # Node available resources
-        nic_cands = defaultdict(list)
-        for n,v in nl.items():
-            if n not in cand_nodes:
-                self.logger.info(f'Not checking node {n} for NICs since it\'s already excluded')
-                continue
+        for r in found:
+            results[r[0]] = r
+            self.filter_cache[(shape, r[0], nl[r[0]].state_version)] = r
+            if len(self.filter_cache) > FILTER_CACHE_SIZE:
+                self.filter_cache.popitem(last=False)
 
-            self.logger.info(f'Checking node {n} for NIC resources')
-            nnic_free[n] = v.GetFreeNumaNicResources()
-
-            pr = list(itertools.product(range(v.numa_nodes), repeat=len(req_nics)))
-            for p in pr: # combination
-                nic_combos = []
-                for numa in range(v.numa_nodes): # Pick out all candidates from this NUMA node
-                    nidx = [i for i,x in enumerate(p) if x == numa]
-                    nic_combos.append(list(itertools.product(range(len(nnic_free[n][numa])), repeat=len(nidx)))) # All ways our pod can map to NICs on this node
-                
-                # Now we make a list of NUMA combinations that we can join together to check for feasible combinations, and we need to combine those to form all possibilities
-                idx_combos = list(itertools.product(*[range(len(x)) for x in nic_combos]))
-
-                for numa_combo_idx in idx_combos:
-                    c = []
-                    nic_ttls = copy.deepcopy(nnic_free[n])
-                    for numaidx,numa in enumerate(numa_combo_idx):
-                        c.append(list(nic_combos[numaidx][numa]))
-
-                    ttl_list = [c[np].pop(0) for np in p]
-
-                    # Now go through each combo and assign throughput to the NICs, and see if it's viable based on current capacity
-                    for xi,xv in enumerate(ttl_list):
-                        nic_ttls[p[xi]][xv][0] -= req_nics[xi][0]
-                        nic_ttls[p[xi]][xv][1] -= req_nics[xi][1]
-
-                    # Check if there are any negative values, meaning the placement could not be done. If none of the numbers were
-                    # negative after removing all requested capacity, this is a valid candidate mapping
-                    if not any([x < 0 for y in nic_ttls for z in y for x in z]):
-                        nic_cands[n].append(list(zip(p,ttl_list)))
-
-            if len(nic_cands[n]) == 0:
-                self.logger.info(f'Dropping node {n} from candidate list since not enough free NIC resources (req={req_nics}, free={nnic_free[n]})')
+        for n, reason, combos, nfree in (results[k] for k in nl):
+            if reason is not None:
+                self.logger.info(f'Dropping node {n} from candidate list since {reason}')
                 cand_nodes.remove(n)
-            else:
-                self.logger.info(f'Node {n} has {len(nic_cands[n])} possible resource combinations to service request of {req_nics}')
-
-        res_cands['nic'] = nic_cands
-  
-        # At this point we're removed any node that doesn't meet one or more of our resource requirements. The next stage is to match
-        # the possibilities up with the best node, and the best hardware on that node
-        return (res_cands, cand_nodes)
-
-
-    def IntersectNumaResources(self, filts):
-        """ At this point we should know all possibly CPU, GPU, and NIC combinations that can be made for a given NUMA node.
-            For each processing group, we now have to determine if there is a valid match of all three resource types
-            on the same NUMA node. 
+                continue
 
-            For example, even though we may have had 4 GPUs free and 20 CPU cores, it's possible that all 4 GPUs are on NUMA
-            node 0, and the 20 CPU cores are on node 1, so it's not a valid match.
-        """
-        self.logger.info('Matching NUMA nodes')
-        cand_list = filts[1].copy()
-        self.logger.info(f'Starting intersection with candidate list: {cand_list}')
+            self.logger.info(f'Node {n} has {len(combos)} valid resource combos. Leaving as candidate')
+            res_cands[n] = combos
+            free[n] = nfree
 
-        for n in cand_list:
-            # For the matching process, we need to go through CPU, GPU, and NIC mappings to find all group mappings that are met for
-            # all three types. We use the GPU list as our loop filter, but it doesn't matter.
-            to_remove = []
+        self.logger.info(f'{len(cand_nodes)} nodes found with sufficient resources')
 
-            gpu_tuples = [x for x in filts[0]['gpu'][n]]
-            cpu_tuples = [x[:-1] for x in filts[0]['cpu'][n]] # CPU pairs reserve the last element for miscellaneous cores
-            nic_tuples = [list(zip(*x))[0] for x in filts[0]['nic'][n]]
+        # At this point we're removed any node that doesn't meet one or more of our resource requirements. The next stage is to match
+        # the possibilities up with the best node, and the best hardware on that node
+        return (res_cands, cand_nodes, free)
 
-            intersect = list(set(gpu_tuples) & set(cpu_tuples) & set(nic_tuples)) # Intersect all tuples so we're left with valid combos
-            self.logger.info(f'Set intersection is {intersect}')
+    @staticmethod
+    def FilterNodeState(st: NodeFreeState, req_gpus, req_cpus, req_nics):
+        """ Checks a single node's free resources against the pod's request. This only touches the snapshot, so it can
+            run in a worker process. Returns (node name, reason the node was dropped or None, combos, free resources). """
+        free_gpus = st.gpus
+        if not NumaSolver.Feasible(req_gpus, free_gpus):
+            return (st.name, f'not enough free GPUs (req={req_gpus}, free={free_gpus})', None, None)
 
-            if len(intersect) == 0:
-                self.logger.info(f'Node {n} has no valid intersection candidates. Removing from list')
-                try:
-                    filts[1].remove(n)
-                except ValueError as e:
-                    self.logger.error(f"Couldn't find node {n} in candidate list: {e}")
+        clist = Matcher.GetNumaCpuRequest(st.smt_enabled, req_cpus)
+        free_cpus = st.cpus
+        if not NumaSolver.Feasible(clist, free_cpus):
+            return (st.name, f'not enough free CPU cores (req={clist}, free={free_cpus})', None, None)
 
-                continue
+        free_nics = st.nics
+        if NumaSolver.NicAssignment(req_nics, free_nics) is None:
+            return (st.name, f'not enough free NIC resources (req={req_nics}, free={free_nics})', None, None)
 
-            # Each type may have to be deleted in a different way, since the format we intersect with is not necessarily the format
-            # it's stored in. This is due to carrying over extra meta data, like interface number on NICs      
+        # Each resource fits on its own. Now search for group mappings where all of them fit on the same NUMA nodes
+        combos = list(NumaSolver.JointMappings(req_gpus, free_gpus, clist, free_cpus, req_nics, free_nics, MAX_NUMA_COMBOS))
+        if len(combos) == 0:
+            return (st.name, 'no NUMA mapping satisfies GPUs, CPUs and NICs together', None, None)
 
-            # GPU first. This one is simple since it's a direct mapping
-            diff = set(filts[0]['gpu'][n]) - set(intersect)
-            if len(diff):
-                self.logger.info(f'Removing {diff} from GPU sets since they\'re not in the intersection')
-                filts[0]['gpu'][n] = intersect
+        return (st.name, None, combos, {'gpu': free_gpus, 'cpu': free_cpus, 'nic': free_nics, 'gpu_req': req_gpus, 'cpu_req': clist})
 
-            # CPU is a bit different since we have the extra miscellaneous cores that aren't part of a group
-            for c in filts[0]['cpu'][n]:
-                if c[:-1] not in intersect:
-                    self.logger.info(f'Removing CPU combo {c} from set since it\'s not in intersection')
-                    filts[0]['cpu'][n].remove(c)
+    def GetPool(self) -> ProcessPoolExecutor:
+        """ Lazily starts the node filtering worker pool. Workers are spawned rather than forked since the scheduler
+            process already has watch and event threads running, and forking those is unsafe. """
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
 
-            
-            # NICs have an even more add mapping since it's a zip() of numa node and interface number
-            for nicidx,nic in enumerate(filts[0]['nic'][n]):
-                tup = list(zip(*nic))[0]
-                if tup not in intersect:
-                    self.logger.info(f'Removing NIC combo {tup} from set since it\'s not in intersection')
-                    del filts[0]['nic'][n][nicidx]
-            
-            num_combos = [len(filts[0][t][n]) > 0 for t in ('gpu','cpu','nic')]
-            if not all(num_combos):
-                self.logger.info(f'Not enough resources of at least one type for node {n}. Removing from candidates')
-                del filts[1][n]
-            else:
-                self.logger.info(f'Node {n} has {len(intersect)} valid resource combos after intersection. Leaving as candidate')
+        return self.pool
 
-        return filts
-        
-    def SelectNode(self, filts):
-        """ Selects the node that will be used for scheduling. At this point we've already made sure the node is adequate
-            to service each type of resource. There are many ways to select which node we're using, but in general, we want
-            to try to pack the pod into a node as tightly as possible, meaning with the fewest leftover resources. Since we
-            have many types of resources, there can be competing objectives. """
+    def SelectNode(self, nl, filts, strategy):
+        """ Selects the node and NUMA mapping that will be used for scheduling. At this point we've already made sure every
+            candidate is adequate to service each type of resource, so which one we pick only affects how well later pods
+            can be packed. Every combination on every node is scored with the given strategy, and the best one wins. """
 
-        # For now, let's just return the first node in the list. Later on we can be smarter.
         if len(filts[1]) == 0:
             self.logger.error('No candidate nodes found!')
-            return ''
-
-        node = filts[1][0]
-        return node
-
-    def GetNumaGroupIdx(self, node, numa_nodes, filts):
-        """ Find the best group index mapping to maximize later bin packing. For now, the criteria will be to maximize
-            the number of GPUs on a particular node. """
-
-        def node_delta(x):
-            el = [filts[0]['gpu'][node][x].count(y) for y in range(numa_nodes)]
-            return max(el) - min(el)
-
-        gidx, gval = (0, node_delta(0))
-
-        for tmpidx in range(1, len(filts[0]['gpu'][node])):
-            tmp = node_delta(tmpidx)
-            if tmp > gval:
-                gidx, gval = tmpidx,tmp
-
-        gtuple = filts[0]['gpu'][node][gidx]
-
-        # CPUs
-        cabbr  = [x[:-1] for x in filts[0]['cpu'][node]]
-        cidx   = cabbr.index(gtuple)
-        ctuple = filts[0]['cpu'][node][cidx]
+            return ('', None)
 
-        # NICs
-        nabbr  = [list(zip(*x))[0] for x in filts[0]['nic'][node]]
-        nidx   = nabbr.index(gtuple)
-        ntuple = filts[0]['nic'][node][nidx]
+        node, midx = self.scorer.Select(nl, filts, strategy)
+        if node is None:
+            return ('', None)
 
-        self.logger.info(f"Index matching done. GPU={gtuple}, cpu={ctuple}, nic={ntuple}")
-        return {'gpu': gtuple, 'cpu': ctuple, 'nic': ntuple}
+        self.logger.info(f"Index matching done. GPU={midx['gpu']}, cpu={midx['cpu']}, nic={midx['nic']}")
+        return node, midx
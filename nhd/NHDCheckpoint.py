@@ -0,0 +1,92 @@
+import json
+import os
+import time
+from nhd.NHDCommon import NHDCommon
+from typing import Dict
+
+CHECKPOINT_ENV          = 'NHD_CHECKPOINT'  # Where to keep the checkpoint: a file path, or configmap:<namespace>/<name>
+CHECKPOINT_CM_PREFIX    = 'configmap:'      # Prefix of a checkpoint location naming a ConfigMap
+CHECKPOINT_CM_KEY       = 'checkpoint.json' # Key holding the checkpoint inside of a ConfigMap
+CHECKPOINT_FORMAT       = 1                 # Bumped whenever the layout changes. Checkpoints of any other format are ignored
+
+
+"""
+Saves and loads the scheduler's allocation checkpoint. The checkpoint is a single JSON document, stored either in
+a file on a local volume or in a ConfigMap, depending on the NHD_CHECKPOINT environment variable. Checkpointing is
+disabled if the variable isn't set.
+"""
+class NHDCheckpoint:
+    def __init__(self, k8s):
+        self.logger = NHDCommon.GetLogger(__name__)
+        self.k8s = k8s
+        self.path = None
+        self.cm = None
+
+        loc = os.environ.get(CHECKPOINT_ENV, '')
+        if loc.startswith(CHECKPOINT_CM_PREFIX):
+            ns, _, name = loc[len(CHECKPOINT_CM_PREFIX):].partition('/')
+            if ns == '' or name == '':
+                self.logger.error(f'Invalid ConfigMap "{loc}" in {CHECKPOINT_ENV}. Checkpointing disabled')
+            else:
+                self.cm = (ns, name)
+        elif loc != '':
+            self.path = loc
+
+        if self.Enabled():
+            self.logger.info(f'Checkpointing allocation state to {loc}')
+
+    def Enabled(self) -> bool:
+        return self.path is not None or self.cm is not None
+
+    def Save(self, nodes: Dict) -> bool:
+        """ Writes a checkpoint holding the given per-node state. A file is written to a temporary name first and moved
+            into place, so a crash mid-write never leaves a partial checkpoint behind. """
+        data = json.dumps({'format': CHECKPOINT_FORMAT, 'time': time.time(), 'nodes': nodes}, separators=(',', ':'))
+
+        if self.cm is not None:
+            return self.k8s.WriteConfigMapKey(self.cm[0], self.cm[1], CHECKPOINT_CM_KEY, data)
+
+        try:
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            self.logger.error(f'Failed to write checkpoint to {self.path}: {e}')
+            return False
+
+        return True
+
+    def Load(self) -> Dict:
+        """ Reads the per-node state from the last checkpoint. Returns None if there isn't a usable checkpoint """
+        if not self.Enabled():
+            return None
+
+        if self.cm is not None:
+            data = self.k8s.ReadConfigMapKey(self.cm[0], self.cm[1], CHECKPOINT_CM_KEY)
+        else:
+            try:
+                with open(self.path) as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = None
+            except OSError as e:
+                self.logger.error(f'Failed to read checkpoint from {self.path}: {e}')
+                data = None
+
+        if data is None:
+            self.logger.info('No checkpoint found')
+            return None
+
+        try:
+            ckpt = json.loads(data)
+        except ValueError as e:
+            self.logger.error(f'Checkpoint is corrupt, ignoring: {e}')
+            return None
+
+        if ckpt.get('format') != CHECKPOINT_FORMAT:
+            self.logger.warning(f'Checkpoint has format {ckpt.get("format")} instead of {CHECKPOINT_FORMAT}, ignoring')
+            return None
+
+        self.logger.info(f'Loaded checkpoint from {time.time() - ckpt["time"]:.1f} seconds ago')
+        return ckpt['nodes']
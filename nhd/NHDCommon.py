@@ -38,3 +38,5 @@ class NHDCommon:
 
 class RpcMsgType(Enum):
     TYPE_NODE_INFO = 1     
+    TYPE_CLUSTER_EVENT = 2 # Not an RPC. Posted by the watch threads to wake the scheduler when the cluster changes
+    TYPE_PLACEMENT_WRITTEN = 3 # Not an RPC. Posted by the placement writers when a pod's API writes finish
@@ -7,16 +7,33 @@ from nhd.NHDCommon import NHDCommon
 from nhd.K8SMgr import K8SEventType
 from colorlog import ColoredFormatter
 from nhd.Node import Node
+from nhd.Node import PodAllocation
+from nhd.NHDCheckpoint import NHDCheckpoint
 from nhd.K8SMgr import K8SMgr
+from nhd.K8SMgr import K8SPodSnapshot
 from nhd.Matcher import Matcher
+from nhd.NodeScorer import SCORE_STRATEGY_ANNOTATION
 from enum import Enum
 from typing import Dict
 from nhd.TriadCfgParser import TriadCfgParser
 from queue import Queue
 from queue import Empty
+from queue import Full
+from concurrent.futures import ThreadPoolExecutor
 from nhd.NHDCommon import RpcMsgType
 
-NHD_SCHED_NAME = "nhd-scheduler"
+NHD_SCHED_NAME          = "nhd-scheduler"
+BATCH_SCHEDULING        = True # Plan every pending pod in a pass before issuing any API writes
+RECONCILE_INTERVAL_SEC  = 30   # Run a full pass at least this often, even if no cluster events arrive
+WAKE_COALESCE_SEC       = 0.02 # After waking up, keep collecting events for this long so a burst is handled in one pass
+ASYNC_PLACEMENT_WRITES  = True # Issue each placement's API writes on a worker pool instead of the scheduler thread
+PLACEMENT_WRITERS       = 8    # Number of placements being written to the API server at once
+RETRY_BACKOFF_BASE_SEC  = 1    # Minimum wait before retrying a pod that didn't fit. Doubles with every failed retry
+RETRY_BACKOFF_MAX_SEC   = 300  # Longest wait between retries of a pod that didn't fit
+MAX_RETRY_PODS          = 1024 # Pods that didn't fit beyond this many are left failed instead of queued for retry
+FINISHED_POD_PHASES     = ('Succeeded', 'Failed') # Pods in any other phase, including Unknown, still hold resources on their node
+CONFIG_LOADERS          = 16   # Number of deployed pod configs fetched and parsed at once when reclaiming resources
+CHECKPOINT_INTERVAL_SEC = 60   # Write an allocation checkpoint at most this often, and only if anything changed
 
 # Scheduler status for each pod 
 class PodStatus(Enum):
@@ -25,6 +42,32 @@ class PodStatus(Enum):
     POD_STATUS_SUCCEEDED = 2
     POD_STATUS_RUNNING = 3
     POD_STATUS_COMPLETED = 4
+    POD_STATUS_ASSUMED = 5   # Resources taken in the node model, but the API writes are still in flight
+
+"""
+A pod that has been placed in memory, but whose placement hasn't been written to the API server yet
+"""
+class PodPlan:
+    def __init__(self, podname, ns, snap, cmname, tcfg, nodename, nadlist, sriov_en):
+        self.podname = podname
+        self.ns = ns
+        self.snap = snap
+        self.cmname = cmname
+        self.tcfg = tcfg
+        self.nodename = nodename
+        self.nadlist = nadlist   # NetworkAttachmentDefinitions of the NICs the pod was given on the node
+        self.sriov_en = sriov_en # Whether the node's NICs are attached with the SR-IOV device plugin
+        self.key = None          # (ns, pod, uid) key into the scheduler's pod state, when scheduled from the main loop
+
+"""
+A pod that didn't fit on any node, waiting for capacity to be freed before it's retried
+"""
+class RetryEntry:
+    def __init__(self, demand, attempts):
+        self.demand = demand     # Node-wide totals the pod needs, from CfgTopology.GetTotalDemand
+        self.attempts = attempts # Number of times the pod has failed to fit
+        self.not_before = time.time() + min(RETRY_BACKOFF_BASE_SEC * (2 ** (attempts - 1)), RETRY_BACKOFF_MAX_SEC)
+        self.ready = False       # Set once a release leaves some node with enough free resources for the pod
 
 """ Main scheduler thread. The basic actions are:
 
@@ -38,12 +81,25 @@ class NHDScheduler(threading.Thread):
         threading.Thread.__init__(self)
         self.logger = NHDCommon.GetLogger(__name__)
         self.nodes = {}
+        self.unavailable = set()  # Nodes still holding pods that can't take new ones: cordoned, NotReady, or untainted
+        self.node_labels = {}     # Labels each node was last initialized from
+        self.node_versions = {}   # resourceVersion of each node object last looked at by SyncNodes
+        self.node_sync_ver = None # Node cache version as of the last SyncNodes
         self.k8s = K8SMgr.GetInstance()
         self.sched_name = NHD_SCHED_NAME
         self.whitelist = []
         self.matcher = Matcher()
         self.pod_state = {}
+        self.pod_locations = {} # (pod, ns) -> node name for every pod holding resources in a node's ledger
+        self.failed_claims = {} # (pod, ns) -> (uid, resourceVersion) of pods whose resources couldn't be claimed
         self.mainq = q
+        self.pass_pending = threading.Event() # Set when a cluster change or freed capacity needs a scheduling pass
+        self.writers = ThreadPoolExecutor(max_workers=PLACEMENT_WRITERS)
+        self.retry_queue: Dict = {} # (ns, pod, uid) -> RetryEntry for pods that didn't fit anywhere
+        self.next_reconcile = 0
+        self.checkpoint = NHDCheckpoint(self.k8s)
+        self.next_checkpoint = 0
+        self.checkpoint_ver = None # Node state versions reflected in the last checkpoint written
 
         self.ver = pkg_resources.get_distribution("nhd").version
         self.logger.warning(f'NHD version {self.ver}')
@@ -55,44 +111,41 @@ class NHDScheduler(threading.Thread):
         """
         self.whitelist = nl
 
-    def InitNHDNodes(self):
+    def InitNHDNodes(self, objs: Dict):
         """
-        Find all nodes handled by NHD given the node taints
+        Find all nodes handled by NHD given the node taints. objs holds every node object by name from ListNodes
         """        
         if len(self.whitelist) > 0:
             self.logger.info('Node whitelist is not empty, using nodes from that list as schedulable nodes')
             for n in self.whitelist:
                 self.nodes[n] = Node(n)
         else:
-            nodes = self.k8s.GetNodes()
-            for n in nodes:
-                if self.k8s.IsNHDTainted(n):
+            for n,o in objs.items():
+                if K8SMgr.IsNodeReady(o) and K8SMgr.HasNHDTaint(o):
                     self.nodes[n] = Node(n)
 
         self.logger.info(f'{len(self.nodes)} nodes are marked as schedulable by NHD: {self.nodes.keys()}')
 
     def BuildInitialNodeList(self):
-        """ Builds the initial list of available nodes on startup. In the future we need to watch for downed nodes and
-            new nodes added later. """
+        """ Builds the initial list of available nodes on startup. Nodes added, removed or changed later are picked up
+            by SyncNodes. Every node is read from one list of node objects, which is used for the taints, addresses,
+            labels and allocatable hugepages, so no per-node API calls are made. """
         self.logger.info("Populating list of nodes") 
-        self.InitNHDNodes()
+        objs = self.k8s.ListNodes()
+        self.InitNHDNodes(objs)
 
-        todel = []
-        for n,v in self.nodes.items():
-            try:
-                v.SetNodeAddr(self.k8s.GetNodeAddr(n))
+        todel = [n for n in self.nodes if n not in objs or not K8SMgr.IsNodeReady(objs[n])]
+        for n in todel:
+            self.logger.error(f'Node {n} is missing or not ready, removing from list')
 
-                if not v.ParseLabels(self.k8s.GetNodeLabels(n)):
-                    self.logger.error(f'Error while parsing labels for node {n}, removing from list')
-                    todel.append(n)
+        # Hugepage accounting is done for all nodes at once rather than listing every pod once per node
+        huge = self.GetHugepages([n for n in self.nodes if n not in todel], objs)
 
-                (alloc, free) = self.k8s.GetNodeHugepageResources(n) 
-                if alloc == 0 or not v.SetHugepages(alloc, free):
-                    self.logger.error(f'Error while parsing allocatable resources for node {n}, removing from list')
-                    todel.append(n)                    
+        for n,v in self.nodes.items():
+            if n in todel:
+                continue
 
-            except Exception as e:
-                print('Caught exception while setting up node {n}:', e)
+            if not self.SetupNode(v, objs[n], huge[n]):
                 todel.append(n)
 
         # Delete all nodes that had issues when parsing
@@ -106,93 +159,422 @@ class NHDScheduler(threading.Thread):
 
         self.logger.info("Done building initial node list")
 
-    def ClaimPodResources(self, podname, ns):
+    def SetupNode(self, v: Node, obj, huge) -> bool:
+        """ Initializes a node's hardware from its node object and (allocatable, free) hugepages. Returns False if the
+            node can't be used """
+        try:
+            v.SetNodeAddr(obj.status.addresses[0].address)
+
+            if not v.ParseLabels(obj.metadata.labels):
+                self.logger.error(f'Error while parsing labels for node {v.name}, removing from list')
+                return False
+
+            (alloc, free) = huge
+            if alloc == 0 or not v.SetHugepages(alloc, free):
+                self.logger.error(f'Error while parsing allocatable resources for node {v.name}, removing from list')
+                return False
+
+        except Exception as e:
+            self.logger.error(f'Caught exception while setting up node {v.name}: {e}')
+            return False
+
+        self.node_labels[v.name] = dict(obj.metadata.labels)
+        return True
+
+    def GetHugepages(self, names, objs = None) -> Dict:
+        """ Gets the (allocatable, free) hugepages of nodes. Hugepages of the pods in a node's ledger are counted from the
+            ledger rather than the pod cache, since pods whose placement is still being written, or was only just bound,
+            don't show up there yet """
+        ledgers = {n: self.nodes[n] for n in names if n in self.nodes}
+        huge = self.k8s.GetHugepageSnapshot(names, objs, {n: set(v.pod_ledger) for n,v in ledgers.items()})
+        for n,v in ledgers.items():
+            if huge[n][0] > 0:
+                huge[n] = (huge[n][0], huge[n][1] - v.GetLedgerHugepages())
+
+        return huge
+
+    def RefreshHugepages(self, names):
+        """ Sets the free hugepages of nodes from the pods using them """
+        for n,(alloc, free) in self.GetHugepages(names).items():
+            if alloc > 0:
+                self.nodes[n].SetHugepages(alloc, free)
+
+    def IsNodeUsable(self, name, obj) -> bool:
+        """ Checks whether new pods can be placed on a node: it must be ours, ready, and not cordoned """
+        ours = name in self.whitelist if len(self.whitelist) > 0 else K8SMgr.HasNHDTaint(obj)
+        return ours and K8SMgr.IsNodeReady(obj) and not obj.spec.unschedulable
+
+    def SyncNodes(self):
+        """ Applies node changes from the node cache since the last call. Only node objects with a new resourceVersion
+            are looked at:
+
+                added:    new usable nodes are initialized from their labels and become candidates
+                removed:  nodes deleted from the cluster are dropped along with the pods placed on them
+                unusable: cordoned, NotReady, or untainted nodes stop being candidates right away, but keep their
+                          ledgers so the pods still running there release their resources normally
+                labels:   changed labels are re-read with Node.RefreshLabels, which keeps resources in use
+
+            Pods waiting for capacity are woken whenever a node is added or becomes usable again. """
+        ver = self.k8s.node_cache_ver
+        if ver is None or ver == self.node_sync_ver:
+            return
+
+        self.node_sync_ver = ver
+        objs = self.k8s.ListNodes()
+
+        for n in [n for n in self.nodes if n not in objs]:
+            self.logger.warning(f'Node {n} was removed from the cluster. Dropping it')
+            del self.nodes[n]
+            self.unavailable.discard(n)
+            self.node_labels.pop(n, None)
+            for pk in [pk for pk,pn in self.pod_locations.items() if pn == n]:
+                del self.pod_locations[pk]
+
+        for n in [n for n in self.node_versions if n not in objs]:
+            del self.node_versions[n]
+
+        added = []
+        refresh = []
+        for n,o in objs.items():
+            if self.node_versions.get(n) == o.metadata.resource_version:
+                continue
+
+            self.node_versions[n] = o.metadata.resource_version
+            usable = self.IsNodeUsable(n, o)
+            if n not in self.nodes:
+                if usable:
+                    added.append(n)
+                continue
+
+            if not usable and n not in self.unavailable:
+                self.logger.warning(f'Node {n} is cordoned, not ready, or no longer tainted for NHD. Removing from candidates')
+                self.unavailable.add(n)
+            elif usable and n in self.unavailable:
+                self.logger.info(f'Node {n} is usable again. Adding back to candidates')
+                self.unavailable.discard(n)
+                self.OnCapacityFreed(n)
+
+            if o.metadata.labels != self.node_labels.get(n):
+                self.logger.info(f'Labels changed on node {n}. Refreshing')
+                dropped = self.nodes[n].RefreshLabels(o.metadata.labels)
+                if dropped is None:
+                    self.logger.error(f'Error while parsing new labels for node {n}. Keeping the old ones')
+                    continue
+
+                for pk in dropped:
+                    self.pod_locations.pop(pk, None)
+
+                self.node_labels[n] = dict(o.metadata.labels)
+                refresh.append(n)
+
+        if len(added) or len(refresh):
+            huge = self.GetHugepages(added + refresh, objs)
+            for n in refresh:
+                if huge[n][0] > 0:
+                    self.nodes[n].SetHugepages(*huge[n])
+
+            for n in added:
+                v = Node(n)
+                if not self.SetupNode(v, objs[n], huge[n]):
+                    continue
+
+                self.logger.info(f'Adding new node {n} to scheduling list')
+                self.nodes[n] = v
+                self.OnCapacityFreed(n)
+
+            # Any pods already running on an added node, or dropped from a refreshed one, are claimed by the next
+            # reconciliation
+            self.next_reconcile = 0
+
+    def GetCandidateNodes(self) -> Dict:
+        """ Nodes new pods can be placed on """
+        if len(self.unavailable) == 0:
+            return self.nodes
+
+        return {n: v for n,v in self.nodes.items() if n not in self.unavailable}
+
+    def ClaimPodResources(self, podname, ns) -> bool:
         """ Claims any pod resources from a given pod's configmap. This will remove any physical node resources consumed
-            by the pod from being scheduled by other pods. """
-        cmname, cfgstr = self.k8s.GetCfgMap(podname, ns)
-        cfgtype = self.k8s.GetCfgType(podname, ns)
+            by the pod from being scheduled by other pods. Returns False if nothing could be claimed. """
+        return self.ApplyPodClaim(podname, ns, self.LoadPodTopology(podname, ns))
+
+    def LoadPodTopology(self, podname, ns):
+        """ Fetches a deployed pod and parses its config into a topology, without touching any node state, so it's safe
+            to run on a worker thread. Returns (topology, node name), or None if the pod can't be claimed. """
+        snap = self.k8s.GetPodSnapshot(podname, ns)
+        if snap is None:
+            self.logger.error(f'Couldn\'t read pod {ns}.{podname} to claim its resources')
+            return None
+
+        cmname, cfgstr = self.k8s.GetCfgMap(podname, ns, snap)
+        cfgtype = self.k8s.GetCfgType(podname, ns, snap)
         tcfg = self.GetCfgParser(cfgtype, cfgstr)
 
         top = tcfg.CfgToTopology(True)
-        if top is not None: # Start removing pod's resources from node
-            n = self.k8s.GetPodNode(podname, ns)
-            if not n:
-                self.logger.error('Pulled pod\'s config, but it wasn\'t assigned a node!')
-                return
-
-            if n not in self.nodes:
-                self.logger.error(f'Pod is mapping to node {n} but that node isn\'t in the current node list. Skipping')
-                return
+        if top is None:
+            return None
+
+        n = self.k8s.GetPodNode(podname, ns, snap)
+        if not n:
+            self.logger.error('Pulled pod\'s config, but it wasn\'t assigned a node!')
+            return None
+
+        # Hugepages come from the pod spec rather than the config, so add them in to be recorded in the ledger
+        top.AddPodReservations(self.ParsePodResources(podname, ns, snap))
+        return (top, n)
+
+    def ApplyPodClaim(self, podname, ns, loaded, refresh = True) -> bool:
+        """ Takes the resources of a pod loaded by LoadPodTopology from its node. Unless refresh is False, the node's
+            free hugepages are refreshed afterwards to pick up pods of other schedulers. Returns False if nothing could
+            be claimed. """
+        if loaded is None:
+            return False
 
-            if self.nodes[n].PodPresent(podname, ns):
-                self.logger.error(f'Pod {ns}.{podname} already scheduled on node {n}! Cannot add again')
-                return 
+        top, n = loaded
+        if n not in self.nodes:
+            self.logger.error(f'Pod is mapping to node {n} but that node isn\'t in the current node list. Skipping')
+            return False
 
-            # Passed all the tests. Now remove the resources from the cluster
-            self.logger.info(f'Taking node resources from {n}')
-            self.nodes[n].RemoveResourcesFromTopology(top)
+        if self.nodes[n].PodPresent(podname, ns):
+            self.logger.error(f'Pod {ns}.{podname} already scheduled on node {n}! Cannot add again')
+            return False
 
-            (alloc, free) = self.k8s.GetNodeHugepageResources(n) 
-            if not self.nodes[n].SetHugepages(alloc, free):
-                self.logger.error(f'Error while parsing allocatable resources for node {n}')
+        # Passed all the tests. Now remove the resources from the cluster
+        self.logger.info(f'Taking node resources from {n}')
+        self.nodes[n].RemoveResourcesFromTopology(top, podname, ns)
+        self.pod_locations[(podname, ns)] = n
+        self.nodes[n].AddScheduledPod(podname, ns)
 
-            self.nodes[n].AddScheduledPod(podname, ns)
+        if refresh:
+            self.RefreshHugepages([n])
 
-    def ResetResources(self):
-        """ Resets all known resources to those that have already been deployed. Useful when deployed resources
-            get out of sync with what's believed to be scheduled. """
-        self.logger.info('Resetting all resource knowledge')
-        for n in self.nodes.values():
-            n.ResetResources()
+        return True
 
-        self.logger.info('Loading all running configuration files')
-        self.LoadDeployedConfigs()
-        self.logger.info('Node resources after reset:')
-        self.PrintAllNodeResources()
-    
     def LoadDeployedConfigs(self):
         """ Loads any configs that were already deployed by this scheduler to be add as a used resource. This typically
             happens when NHD is restarted after pods have been deployed. """
         self.logger.info('Looking for any pods already deployed with used resources')
         pods = self.k8s.GetScheduledPods(self.sched_name)
         self.logger.info(f'Found scheduled pods: {pods}')
-        for p in pods:
-            if p[2] in ('Running', 'CrashLoopBackOff', 'Pending'):
+
+        # Fetching and parsing each config is independent, so those run on a pool. The claims themselves change node
+        # state and are applied here one at a time, in the same order as before, as each config becomes ready. Pods
+        # already restored from a checkpoint hold their resources and are skipped
+        active = [p for p in pods if p[2] not in FINISHED_POD_PHASES and (p[0], p[1]) not in self.pod_locations]
+        with ThreadPoolExecutor(max_workers=CONFIG_LOADERS) as pool:
+            for p, loaded in zip(active, pool.map(lambda p: self.LoadPodTopology(p[0], p[1]), active)):
                 self.logger.info(f'Reclaiming resources for pod {p[1]}.{p[0]}')
-                self.ClaimPodResources(p[0], p[1])
+                self.ApplyPodClaim(p[0], p[1], loaded, False)
 
+        # Hugepages are refreshed once for every node rather than after each claim
+        self.RefreshHugepages(list(self.nodes.keys()))
+
+
+    def SaveCheckpoint(self):
+        """ Writes every node's pod ledger to the checkpoint, tagged with the uid and resourceVersion of each pod it
+            reflects. Pods whose placement is still being written aren't bound yet, so they're left out. """
+        ver = tuple((n, v.state_version) for n,v in self.nodes.items())
+        if ver == self.checkpoint_ver:
+            return
+
+        assumed = {(k[1], k[0]) for k,s in self.pod_state.items() if s == PodStatus.POD_STATUS_ASSUMED}
+        pods = self.k8s.GetPodVersions(self.sched_name)
+        nodes = {}
+        for n,v in self.nodes.items():
+            entries = []
+            for (pod, ns), alloc in v.pod_ledger.items():
+                if (pod, ns) in assumed or (pod, ns) not in pods:
+                    continue
+
+                uid, rv = pods[(pod, ns)][:2]
+                entries.append(dict(alloc.ToDict(), pod=pod, ns=ns, uid=uid, rv=rv))
+
+            nodes[n] = {'hw': v.GetHardwareId(), 'pods': entries}
+
+        if self.checkpoint.Save(nodes):
+            self.checkpoint_ver = ver
+            self.logger.debug(f'Wrote checkpoint of {sum(len(x["pods"]) for x in nodes.values())} pods')
+
+    def RestoreCheckpoint(self):
+        """ Takes the resources of every pod in the last checkpoint that's still running on the same node. A pod's node
+            and config can't change once it's bound, so a pod with the same uid on the same node still holds exactly
+            what was saved, even if its resourceVersion moved on from status updates. Pods that are gone or were
+            replaced aren't restored, and anything not restored is claimed from its config by LoadDeployedConfigs. """
+        ckpt = self.checkpoint.Load()
+        if ckpt is None:
+            return
+
+        pods = self.k8s.GetPodVersions(self.sched_name)
+        restored, updated, stale = 0, 0, 0
+        for n,nv in ckpt.items():
+            if n not in self.nodes:
+                self.logger.info(f'Node {n} from checkpoint is no longer schedulable, skipping')
+                continue
+
+            if nv['hw'] != self.nodes[n].GetHardwareId():
+                self.logger.warning(f'Hardware on node {n} changed since the checkpoint, skipping')
+                continue
+
+            for e in nv['pods']:
+                cur = pods.get((e['pod'], e['ns']))
+                if cur is None or cur[0] != e['uid'] or cur[2] != n or cur[3] in FINISHED_POD_PHASES:
+                    stale += 1
+                    continue
+
+                if not self.nodes[n].RestoreAllocation(e['pod'], e['ns'], PodAllocation.FromDict(e)):
+                    self.logger.warning(f'Couldn\'t restore pod {e["ns"]}.{e["pod"]} on node {n} from checkpoint')
+                    continue
+
+                self.pod_locations[(e['pod'], e['ns'])] = n
+                restored += 1
+                if cur[1] != e['rv']:
+                    updated += 1
+
+        # Free hugepages come from the pods actually running, so refresh them now the ledgers are back in place
+        self.RefreshHugepages(list(self.nodes.keys()))
+
+        self.logger.info(f'Restored {restored} pods from checkpoint ({updated} with newer status). {stale} pods were '
+                         'gone or replaced')
+
+    def Reconcile(self, pods) -> Dict:
+        """ Compares the pods the scheduler believes are placed against the pods actually bound to NHD nodes, and fixes
+            up only the pods that differ. pods is the result of ServicePods. Pods whose placement is still being written
+            are skipped since they aren't bound yet. Pods whose resources couldn't be claimed are only tried again once
+            the pod changes. Returns the drift found as a dict of lists of (pod, ns):
+
+                leaked:   holding resources, but gone from the cluster or finished. Their resources are released
+                missing:  unfinished on a node, but not holding any resources. Their resources are claimed
+                moved:    holding resources on a different node than the one they're bound to. Moved to the right node
+                orphaned: in a node's ledger without being tracked as placed. Released from that node
+        """
+        present = {}
+        versions = {}
+        for k,p in pods.items():
+            # A pod on a NotReady or unreachable node reports Unknown while it may well still be running, so only a
+            # finished pod has given its resources back
+            if p[0] not in FINISHED_POD_PHASES:
+                present[(k[1], k[0])] = p[1]
+                versions[(k[1], k[0])] = (k[2], p[2])
+
+        self.failed_claims = {pk: v for pk,v in self.failed_claims.items() if versions.get(pk) == v}
+
+        actual = {pk: n for pk,n in present.items() if n in self.nodes}
+
+        assumed = {(k[1], k[0]) for k,s in self.pod_state.items() if s == PodStatus.POD_STATUS_ASSUMED}
+
+        drift = {'leaked': [], 'missing': [], 'moved': [], 'orphaned': []}
+        for pk,n in list(self.pod_locations.items()):
+            if pk in assumed:
+                continue
+
+            # A pod we just bound may not show its node in the cache yet, so only a different node counts as moved
+            if pk not in present:
+                drift['leaked'].append(pk)
+            elif pk in actual and actual[pk] != n:
+                drift['moved'].append(pk)
+
+        for pk in actual:
+            if pk not in self.pod_locations and pk not in assumed and pk not in self.failed_claims:
+                drift['missing'].append(pk)
+
+        for n,v in self.nodes.items():
+            for pk in v.pod_ledger:
+                if self.pod_locations.get(pk) != n:
+                    drift['orphaned'].append((pk, n))
+
+        for (pod, ns), n in drift['orphaned']:
+            self.logger.warning(f'Pod {ns}.{pod} is in the ledger of node {n} without being tracked there. Releasing')
+            if self.nodes[n].ReleasePodResources(pod, ns):
+                self.OnCapacityFreed(n)
+
+        for pod, ns in drift['leaked']:
+            self.logger.warning(f'Pod {ns}.{pod} is holding resources but is gone or finished. Releasing')
+            self.ReleasePodResources(pod, ns)
+
+        for pod, ns in drift['moved']:
+            self.logger.warning(f'Pod {ns}.{pod} is holding resources on node {self.pod_locations[(pod, ns)]} but is bound '
+                                f'to node {actual[(pod, ns)]}. Moving')
+            self.ReleasePodResources(pod, ns)
+            self.ClaimOrRemember(pod, ns, versions[(pod, ns)])
+
+        for pod, ns in drift['missing']:
+            self.logger.warning(f'Pod {ns}.{pod} is running on node {actual[(pod, ns)]} without holding resources. Claiming')
+            self.ClaimOrRemember(pod, ns, versions[(pod, ns)])
+
+        found = sum(len(v) for v in drift.values())
+        if found:
+            self.logger.warning(f'Reconciliation fixed {found} pods: ' + ', '.join(f'{len(v)} {k}' for k,v in drift.items()))
+        else:
+            self.logger.debug('Reconciliation found no drift')
+
+        return drift
+
+    def ClaimOrRemember(self, podname, ns, ver):
+        """ Claims a pod's resources during reconciliation. If that fails, the pod's (uid, resourceVersion) is remembered
+            so it isn't tried again until the pod changes """
+        if not self.ClaimPodResources(podname, ns):
+            self.logger.error(f'Couldn\'t claim resources of pod {ns}.{podname}. Not retrying until the pod changes')
+            self.failed_claims[(podname, ns)] = ver
 
     def ReleasePodResources(self, podname, ns):
-        """ Releases resources consumed by a pod that's completed or errored """
+        """ Releases resources consumed by a pod that's completed or errored. The resources are looked up in the
+            ledger of the node the pod was placed on, so no API calls or config parsing are needed. """
         self.logger.info(f'Releasing resources for pod {ns}.{podname}')
-        cmname, cfgstr = self.k8s.GetCfgMap(podname, ns)
-        if cmname == None:
-            self.logger.warning(f'Pod {ns}.{podname} not found. Possibly already removed from a previous event, such as an error or a job completing. Triggering re-scan of all pods...')
-            self.ResetResources()
+        n = self.pod_locations.pop((podname, ns), None)
+        if n is None:
+            self.logger.warning(f'Pod {ns}.{podname} is not holding any resources. Possibly already removed from a previous event, such as an error or a job completing')
             return
 
-        cfgtype = self.k8s.GetCfgType(podname, ns)
-        tcfg = self.GetCfgParser(cfgtype, cfgstr)        
-        top = tcfg.CfgToTopology(True)
+        if n not in self.nodes:
+            self.logger.error(f'Pod is mapping to node {n} but that node isn\'t in the current node list. Skipping')
+            return
 
-        if top is not None: # Start removing pod's resources from node
-            n = self.k8s.GetPodNode(podname, ns)
-            if not n:
-                self.logger.error('Pulled pod\'s config, but it wasn\'t assigned a node!')
-                return
+        # Passed all the tests. Now give the resources back to the node
+        self.logger.info(f'Freeing node resources from {n}')
+        if not self.nodes[n].ReleasePodResources(podname, ns):
+            self.logger.error(f'Pod {ns}.{podname} has no ledger entry on node {n}! Cannot remove')
+            return
 
-            if n not in self.nodes:
-                self.logger.error(f'Pod is mapping to node {n} but that node isn\'t in the current node list. Skipping')
-                return
+        self.OnCapacityFreed(n)
+
+    def OnCapacityFreed(self, nodename):
+        """ Marks every queued pod that might now fit on a node as ready to retry. Capacity can also be freed between
+            passes, such as when an assumed pod's writes fail, so a pass is requested whenever any pod becomes ready """
+        if nodename in self.unavailable:
+            return
+
+        node = self.nodes[nodename]
+        for k,e in self.retry_queue.items():
+            if not e.ready and node.MayFit(e.demand):
+                self.logger.info(f'Capacity freed on node {nodename} may fit pod {k[0]}.{k[1]}[{k[2]}]. Queueing for retry')
+                e.ready = True
+                self.pass_pending.set()
+
+    def QueueRetry(self, key, demand, attempts):
+        """ Queues a pod that didn't fit anywhere to be retried once capacity is freed """
+        if len(self.retry_queue) >= MAX_RETRY_PODS:
+            self.logger.warning(f'Retry queue is full. Pod {key[0]}.{key[1]}[{key[2]}] will not be retried')
+            return
 
-            if not self.nodes[n].PodPresent(podname, ns):
-                self.logger.error(f'Pod {ns}.{podname} is not scheduled on node {n}! Cannot remove')
-                return 
+        self.retry_queue[key] = RetryEntry(demand, attempts)
 
-            # Passed all the tests. Now remove the resources from the cluster
-            self.logger.info(f'Freeing node resources from {n}')
-            self.nodes[n].AddResourcesFromTopology(top)
-            self.nodes[n].RemoveScheduledPod(podname, ns)
+    def GetRetryPods(self, pods):
+        """ Pulls every pod out of the retry queue that's ready and past its backoff, and still pending in the cluster """
+        now = time.time()
+        due = []
+        for k,e in list(self.retry_queue.items()):
+            if k not in pods or pods[k][0] != 'Pending' or pods[k][1] != None:
+                del self.retry_queue[k]
+            elif e.ready and now >= e.not_before:
+                due.append((k, e.attempts))
+                del self.retry_queue[k]
+
+        return due
+
+    def NextRetryDelay(self):
+        """ Time until the next ready pod in the retry queue comes out of its backoff, or None if there isn't one """
+        waits = [e.not_before - time.time() for e in self.retry_queue.values() if e.ready]
+        return max(0, min(waits)) if len(waits) else None
 
 
     def PrintAllNodeResources(self):
@@ -202,11 +584,11 @@ class NHDScheduler(threading.Thread):
         for _,n in self.nodes.items():
             n.PrintResourceStats()
 
-    def ParsePodResources(self, pod: str, ns: str) -> Dict[str, int]:
+    def ParsePodResources(self, pod: str, ns: str, snap: K8SPodSnapshot = None) -> Dict[str, int]:
         """
         Parse the native pod resources of a node
         """
-        res = self.k8s.GetRequestedPodResources(pod, ns)
+        res = self.k8s.GetRequestedPodResources(pod, ns, snap)
 
         # We only care about a subset of the resources for a pod to schedule on
         trimmed = {}
@@ -224,79 +606,204 @@ class NHDScheduler(threading.Thread):
 
     def AttemptScheduling(self, podname, ns) -> bool:
         """
-        Attempt to schedule a pod to a node. This is the main entry point for the scheduler, and is kicked off
-        whenever a new pod appears in the cluster that wants to use this scheduler. 
+        Attempt to schedule a pod to a node. The pod is first placed against the in-memory node state, and the
+        placement is then written out to the API server.
+        """
+        plan = self.PlanPod(podname, ns)
+        if plan is None:
+            return False
+
+        return self.CommitPod(plan)
+
+    def ScheduleBatch(self, pending, unfit = None) -> Dict:
+        """
+        Schedules every pending pod in one pass. All pods are placed against the in-memory node state first, in the
+        same order they would have been scheduled one at a time, so the placements are identical. The API writes
+        for each placement are issued afterwards. Since free resources only shrink while planning, once a request
+        shape fails to fit, every later pod with the same shape is failed without running the matcher again.
+
+        With ASYNC_PLACEMENT_WRITES on, the writes are handed to the writer pool and the pods are left assumed: their
+        resources are taken in the node model, and the result is applied by OnPlacementWritten once the writes finish.
+
+        pending is a list of (ns, pod, uid) keys. Returns a dict of key -> PodStatus. If unfit is given, the total
+        demand of every pod that failed because it didn't fit on any node is added to it by key.
+        """
+        self.logger.info(f'Planning batch of {len(pending)} pods')
+        infeasible = set()
+        plans = []
+        res = {}
+        for k in pending:
+            demand = {}
+            plan = self.PlanPod(k[1], k[0], infeasible, demand)
+            if plan is None:
+                res[k] = PodStatus.POD_STATUS_FAILED
+                if unfit is not None and len(demand):
+                    unfit[k] = demand
+            else:
+                plan.key = k
+                plans.append(plan)
+
+        self.logger.info(f'Placed {len(plans)}/{len(pending)} pods in memory. Writing placements')
+        for plan in plans:
+            if ASYNC_PLACEMENT_WRITES:
+                self.writers.submit(self.RunPlacementWrites, plan)
+                res[plan.key] = PodStatus.POD_STATUS_ASSUMED
+            else:
+                res[plan.key] = PodStatus.POD_STATUS_SCHEDULED if self.CommitPod(plan) else PodStatus.POD_STATUS_FAILED
+
+        return res
+
+    def RunPlacementWrites(self, plan: PodPlan):
+        """ Runs on the writer pool. Does a pod's API writes and hands the result back to the scheduler thread, which
+            owns the node model """
+        try:
+            ok = self.WritePlacement(plan)
+        except Exception as e:
+            self.logger.error(f'Exception while writing placement for pod {plan.ns}.{plan.podname}: {e}')
+            ok = False
+
+        self.mainq.put((RpcMsgType.TYPE_PLACEMENT_WRITTEN, (plan, ok)))
+
+    def OnPlacementWritten(self, plan: PodPlan, ok: bool):
+        """ Applies the result of an assumed pod's API writes on the scheduler thread """
+        if self.pod_state.get(plan.key) != PodStatus.POD_STATUS_ASSUMED:
+            # The pod left the cluster while its writes were in flight, and its resources were released then
+            self.logger.info(f'Pod {plan.ns}.{plan.podname} is no longer assumed. Ignoring result of its placement writes')
+            return
+
+        self.FinishPlacement(plan, ok)
+        if ok:
+            self.pod_state[plan.key] = PodStatus.POD_STATUS_SCHEDULED
+        else:
+            self.logger.error(f'Failed scheduling pod {plan.ns}.{plan.podname}')
+            self.pod_state[plan.key] = PodStatus.POD_STATUS_FAILED
+
+    def PlanPod(self, podname, ns, infeasible = None, demand = None) -> PodPlan:
+        """
+        Finds a node for a pod and assigns it physical resources in memory. No changes are made to the pod on the API
+        server. If infeasible is given, it's a set of request shapes already known not to fit anywhere; pods with those
+        shapes fail right away, and shapes that fail here are added to it. If demand is given and the pod didn't fit on
+        any node, it's filled in with the pod's total demand. Returns None if the pod couldn't be placed.
         """
         self.k8s.GeneratePodEvent(podname, ns, 'StartedScheduling', K8SEventType.EVENT_TYPE_NORMAL, \
                 f'Started scheduling {ns}/{podname}')
 
-        cmname, cfgstr = self.k8s.GetCfgMap(podname, ns)  
-        cfgtype = self.k8s.GetCfgType(podname, ns)
+        # Fetch the pod once for this attempt and serve every later lookup from the snapshot
+        snap = self.k8s.GetPodSnapshot(podname, ns)
+        if snap is None:
+            self.k8s.GeneratePodEvent(podname, ns, 'FailedScheduling', K8SEventType.EVENT_TYPE_WARNING, \
+                    f'Failed to read pod spec for {ns}/{podname}')
+            return None
+
+        cmname, cfgstr = self.k8s.GetCfgMap(podname, ns, snap)
+        cfgtype = self.k8s.GetCfgType(podname, ns, snap)
         tcfg = self.GetCfgParser(cfgtype, cfgstr)
 
         top = tcfg.CfgToTopology(False)
         if top is None:
             self.k8s.GeneratePodEvent(podname, ns, 'FailedCfgParse', K8SEventType.EVENT_TYPE_WARNING, \
                     f'Error while processing config for pod {podname}')
-            return False
+            return None
 
         # Some of the resource requirements are posted as part of a pod's spec and not the application config. 
         # Pull those into the topology config here
-        pod_res = self.ParsePodResources(podname, ns)
+        pod_res = self.ParsePodResources(podname, ns, snap)
         top.AddPodReservations(pod_res)
 
-        match = self.matcher.FindNode(self.nodes, top)
+        shape = top.GetRequestShape()
+        if infeasible is not None and shape in infeasible:
+            self.logger.info(f'Pod {ns}.{podname} has the same request as a pod that already failed in this pass')
+            match = (None,)
+        else:
+            strategy = self.k8s.GetPodAnnotation(podname, ns, SCORE_STRATEGY_ANNOTATION, snap)
+            match = self.matcher.FindNode(self.GetCandidateNodes(), top, strategy)
+
         nodename = match[0]
 
         if nodename == None:
+            if infeasible is not None:
+                infeasible.add(shape)
+
+            if demand is not None:
+                demand.update(top.GetTotalDemand())
+
             self.k8s.GeneratePodEvent(podname, ns, 'FailedScheduling', K8SEventType.EVENT_TYPE_WARNING, \
                     f'No valid candidate nodes found for scheduling pod {podname}')
-            return False
+            return None
 
         self.k8s.GeneratePodEvent(podname, ns, 'Scheduling', K8SEventType.EVENT_TYPE_NORMAL, \
                 f'Node {nodename} selected for scheduling')
 
         try:
-           nic_list = self.nodes[nodename].SetPhysicalIdsFromMapping(match[1], top)
+           nic_list = self.nodes[nodename].SetPhysicalIdsFromMapping(match[1], top, podname, ns)
         except IndexError:
             # If we end up here, no resources have been mapped and we should not try to finish assigning the pod
             self.logger.error('Failed to map physical resources from topology config!')
-            return False
+            return None
+
+        self.pod_locations[(podname, ns)] = nodename
 
         # Set the NetworkAttachmentDefinition
         nidx = list({x[0] for x in nic_list})
 
-        self.nodes[nodename].ClaimPodNICResources(nidx)
+        self.nodes[nodename].ClaimPodNICResources(nidx, podname, ns)
+
+        # Everything the writes need from the node is copied into the plan here, since the node may be changed or
+        # removed by the time they run
+        return PodPlan(podname, ns, snap, cmname, tcfg, nodename, self.nodes[nodename].GetNADListFromIndices(nidx),
+                       self.nodes[nodename].sriov_en)
+
+    def CommitPod(self, plan: PodPlan) -> bool:
+        """
+        Writes a pod's in-memory placement out to the API server and applies the result to the node model. Any
+        failure gives the pod's resources back to its node.
+        """
+        ok = self.WritePlacement(plan)
+        self.FinishPlacement(plan, ok)
+        return ok
+
+    def FinishPlacement(self, plan: PodPlan, ok: bool):
+        """ Applies the outcome of a pod's placement writes to the node model """
+        if ok and plan.nodename in self.nodes:
+            self.nodes[plan.nodename].AddScheduledPod(plan.podname, plan.ns)
+        elif ok:
+            self.logger.warning(f'Node {plan.nodename} was removed while pod {plan.ns}.{plan.podname} was being placed')
+        else:
+            self.logger.info('Freeing all resources from failed scheduling')
+            self.ReleasePodResources(plan.podname, plan.ns)
+
+    def WritePlacement(self, plan: PodPlan) -> bool:
+        """
+        Writes a pod's in-memory placement out to the API server: network attachments, the filled-in ConfigMap, and
+        finally the binding. This only uses what's in the plan and never touches the node model, so it's safe to run
+        off the scheduler thread.
+        """
+        podname, ns, snap, nodename, nadlist = (plan.podname, plan.ns, plan.snap, plan.nodename, plan.nadlist)
 
-        nadlist = self.nodes[nodename].GetNADListFromIndices(nidx)
-        if self.nodes[nodename].sriov_en:
+        if plan.sriov_en:
             csnad = ','.join(nadlist)
         else:
             # Host-device plugin we want to stick with the same name of the if
             csnad = ','.join([f'{x}@{x}' for x in nadlist])
 
-        if not self.k8s.AddNADToPod(podname, ns, csnad):
+        if not self.k8s.AddNADToPod(podname, ns, csnad, snap):
             self.logger.error('Failed to set NetworkAttachmentDefinition')
-            self.ReleasePodResources(podname, ns)
             return False
 
-        if self.nodes[nodename].sriov_en: # The SR-IOV device plugin requires extra resources labeled for the pod
+        if plan.sriov_en: # The SR-IOV device plugin requires extra resources labeled for the pod
             unames = set(nadlist)
             for name in unames:
                 num = nadlist.count(name)
-                if not self.k8s.AddSRIOVDevice(podname, ns, name, num):
-                    self.logger.info('Freeing all resources from failed scheduling')
-                    self.ReleasePodResources(podname, ns)
+                if not self.k8s.AddSRIOVDevice(podname, ns, name, num, snap):
                     return False
 
         # Finally, we map the filled-in topology config back into the appropriate format for the pod
-        topstr = tcfg.TopologyToCfg()
+        topstr = plan.tcfg.TopologyToCfg()
 
         # Now patch the pod's configmap with the new one
-        if not self.k8s.ReplaceConfigMap(ns, cmname, topstr):
+        if not self.k8s.ReplaceConfigMap(ns, plan.cmname, topstr):
             self.k8s.GeneratePodEvent(podname, ns, 'CfgMapFailed', K8SEventType.EVENT_TYPE_WARNING, \
                     f'Failed to replace ConfigMap. Unwinding changes')
-            self.ReleasePodResources(podname, ns)
             return False
         else:
             self.k8s.GeneratePodEvent(podname, ns, 'CfgMapSuccess', K8SEventType.EVENT_TYPE_NORMAL, \
@@ -306,15 +813,12 @@ class NHDScheduler(threading.Thread):
             self.logger.info('Failed to bind pod to node. Unwinding...')
             self.k8s.GeneratePodEvent(podname, ns, 'FailedScheduling', K8SEventType.EVENT_TYPE_WARNING, \
                     f'Failed to schedule {ns}/{podname} to {nodename}')
-            self.ReleasePodResources(podname, ns)
             return False
         else:
             self.logger.warning(f'Successfully bound pod {podname} to node {nodename}!')
             self.k8s.GeneratePodEvent(podname, ns, 'Scheduled', K8SEventType.EVENT_TYPE_NORMAL, \
                     f'Successfully assigned {ns}/{podname} to {nodename}')
 
-        self.nodes[nodename].AddScheduledPod(podname, ns)
-
         return True
 
     def GetBasicNodeStats(self):
@@ -350,59 +854,144 @@ class NHDScheduler(threading.Thread):
             rsp = self.GetBasicNodeStats()
             q.put(rsp)
 
+    def OnClusterEvent(self, kind, etype, obj):
+        """
+        Called from the K8SMgr watch threads whenever the pod or node cache changes. Wakes up the main loop if the
+        change could affect scheduling: any of our pods changing, nodes coming or going, or one of our nodes changing.
+        """
+        if kind == 'pod' and obj is not None and obj.spec.scheduler_name != self.sched_name:
+            return
+
+        if kind == 'node' and etype == 'MODIFIED' and obj.metadata.name not in self.nodes and \
+           not self.IsNodeUsable(obj.metadata.name, obj):
+            return
+
+        # The flag is what guarantees the pass. The message only wakes the loop if it's blocked on an empty queue, so
+        # it's fine to drop when the queue is full, since the loop checks the flag after every message it takes
+        self.pass_pending.set()
+        try:
+            self.mainq.put_nowait((RpcMsgType.TYPE_CLUSTER_EVENT, None))
+        except Full:
+            pass
+
+    def HandleMessage(self, item):
+        """ Handles a main queue message that doesn't need a scheduling pass """
+        if item[0] == RpcMsgType.TYPE_PLACEMENT_WRITTEN:
+            self.OnPlacementWritten(*item[1])
+        else:
+            self.ParseRPCReq(item[0], item[1])
+
+    def WaitForWork(self, timeout = None):
+        """
+        Blocks until a scheduling pass is needed, answering RPC requests and applying the results of placement writes
+        as they come in without running a pass. A pass is needed once a cluster event or freed capacity has set
+        pass_pending, or once RECONCILE_INTERVAL_SEC passes with nothing happening. After the first cluster event, any
+        events arriving within WAKE_COALESCE_SEC are folded into the same pass. If timeout is given, a pass is run after
+        that many seconds at the latest.
+        """
+        deadline = time.time() + (RECONCILE_INTERVAL_SEC if timeout is None else min(timeout, RECONCILE_INTERVAL_SEC))
+        while not self.pass_pending.is_set():
+            try:
+                item = self.mainq.get(True, max(0, deadline - time.time()))
+            except Empty:
+                self.logger.debug('Reconcile interval elapsed without cluster events')
+                return
+
+            if item[0] != RpcMsgType.TYPE_CLUSTER_EVENT:
+                self.HandleMessage(item)
+
+        end = time.time() + WAKE_COALESCE_SEC
+        while time.time() < end:
+            try:
+                item = self.mainq.get(True, max(0, end - time.time()))
+            except Empty:
+                break
+
+            if item[0] != RpcMsgType.TYPE_CLUSTER_EVENT:
+                self.HandleMessage(item)
+
+        # Cleared before the pass reads the caches, so any change from here on sets it again and gets its own pass
+        self.pass_pending.clear()
+        self.logger.debug('Woke up for cluster events')
+
     def run(self):
         """ 
         Main entry point for NHD. Initialization pulls node information, and sets up all data structures needed
         for scheduling a pod.
         """
+        self.k8s.AddEventListener(self.OnClusterEvent)
+        self.k8s.StartWatchers()
         self.BuildInitialNodeList()
+        self.RestoreCheckpoint()
         self.LoadDeployedConfigs()
         self.PrintAllNodeResources()
 
         self.logger.warning("Starting main scheduler loop")
 
         while True:
-            # Start watching for pods that want to be scheduled or are waiting to be freed
+            # Pick up any nodes that were added, removed, or changed since the last pass
+            self.SyncNodes()
+
+            # Start watching for pods that want to be scheduled or are waiting to be freed. This is served from the
+            # K8SMgr pod cache, which is periodically relisted in full to guarantee reconciliation.
             pods = self.k8s.ServicePods(self.sched_name)
 
-            # Check if we need to delete any pods now
+            # Check if we need to delete any pods now. Finished pods are filtered out of the pod cache by the API server,
+            # so pods that failed or completed show up here as gone too
             todel = []
             for k,p in self.pod_state.items():
                 if k not in pods:
                     todel.append(k)
 
             for v in todel:
-                self.logger.info(f'Pod {v[0]}.{v[1]}[{v[2]}] no longer in cluster. Freeing resources')
+                self.logger.info(f'Pod {v[0]}.{v[1]}[{v[2]}] finished or no longer in cluster. Freeing resources')
                 self.ReleasePodResources(v[1],v[0])
                 del self.pod_state[v]
 
+            # Every so often, check that what we think is placed matches the cluster and fix up anything that doesn't
+            if time.time() >= self.next_reconcile:
+                self.Reconcile(pods)
+                self.next_reconcile = time.time() + RECONCILE_INTERVAL_SEC
+
+            # Pods that didn't fit earlier are only retried once a release has freed enough capacity somewhere
+            attempts = {}
+            for k,a in self.GetRetryPods(pods):
+                self.logger.info(f'Retrying pod {k[0]}.{k[1]}[{k[2]}] after {a} failed attempts')
+                self.pod_state.pop(k, None)
+                attempts[k] = a
+
             # Schedule any new pods
+            pending = []
             for k,p in pods.items():
                 if p[0] == 'Pending' and p[1] == None and (k not in self.pod_state):
                     self.logger.info(f'Found new pending pod {k[0]}.{k[1]}[{k[2]}]')
                     # Normal pod that needs to be scheduled
-                    if not self.AttemptScheduling(k[1],k[0]):
+                    if BATCH_SCHEDULING:
+                        pending.append(k)
+                    elif not self.AttemptScheduling(k[1],k[0]):
                         self.logger.error(f'Failed scheduling pod {k[0]}.{k[1]}[{k[2]}]')
                         self.pod_state[k] = PodStatus.POD_STATUS_FAILED
                     else:
                         self.pod_state[k] = PodStatus.POD_STATUS_SCHEDULED
 
-                elif (p[0] == 'Failed') and (k in self.pod_state) and (self.pod_state[k] == PodStatus.POD_STATUS_SCHEDULED):
-                    self.logger.info(f'Pod {k[0]}.{k[1]}[{k[2]}] failed to schedule. Removing consumed resources')
-                    self.ReleasePodResources(k[1],k[0])
-                    self.pod_state[k] = PodStatus.POD_STATUS_FAILED
+            if len(pending):
+                unfit = {}
+                res = self.ScheduleBatch(pending, unfit)
+                for k in pending:
+                    if res[k] == PodStatus.POD_STATUS_FAILED:
+                        self.logger.error(f'Failed scheduling pod {k[0]}.{k[1]}[{k[2]}]')
+                        if k in unfit:
+                            self.QueueRetry(k, unfit[k], attempts.get(k, 0) + 1)
+                    self.pod_state[k] = res[k]
 
             self.logger.debug(f'Done processing {len(pods)} pods. {len(self.pod_state)} pods in cache')
 
-            # Check RPC before sleeping
-            try:
-                item = self.mainq.get(True, 5)
+            if self.checkpoint.Enabled() and time.time() >= self.next_checkpoint:
+                self.SaveCheckpoint()
+                self.next_checkpoint = time.time() + CHECKPOINT_INTERVAL_SEC
 
-                self.ParseRPCReq(item[0], item[1])
-                
-            except Empty as e:
-                self.logger.debug('Empty gRPC queue')     
-                continue           
+            # Sleep until the cluster changes, serving RPC requests in the meantime
+            self.WaitForWork(self.NextRetryDelay())           
             
 
                 
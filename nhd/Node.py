@@ -7,8 +7,9 @@ from nhd.CfgTopology import GpuType
 from nhd.CfgTopology import NICCoreDirection
 from nhd.CfgTopology import CfgTopology
 from pprint import pprint
-from typing import Dict, List, Tuple
-from itertools import chain
+from typing import Dict, List, NamedTuple, Tuple
+from itertools import chain, count
+from bisect import insort
 
 NIC_BW_AVAIL_PERCENT                = 0.9 # Only allow NICs to be scheduled up to this much of their total capacity
 SCHEDULABLE_NIC_SPEED_THRESH_MBPS   = 11000 # Don't include NICs for scheduling that are below this speed
@@ -16,17 +17,99 @@ ENABLE_SRIOV                        = False # Allow SR-IOV sharing
 ENABLE_SHARING                      = False # Allow pods to share a NIC
 
 """
-Properties of a core inside of a node
+State of every logical CPU core inside of a node, kept as integer bitmaps where bit c refers to logical core c.
+With SMT enabled, logical cores c and c + phys_cores are siblings on the same physical core. The per-socket masks
+cover the physical cores, so finding or counting the free physical cores on a socket only takes a few bit operations.
 """
-class NodeCore:
-    def __init__(self, core, socket, sib):
-        self.core: int = core
-        self.sibling: int = sib
-        self.socket: int = socket
-        self.used: bool = False
+class NodeCpuMap:
+    def __init__(self, cores: int, sockets: int, smt: bool):
+        self.phys_cores = cores
+        self.sockets = sockets
+        self.smt = smt
+        self.num_cores = cores*2 if smt else cores
+        self.phys_mask = (1 << cores) - 1
+        self.used = 0     # Logical cores in use, including reserved ones
+        self.reserved = 0 # Logical cores reserved for the OS
+
+        # Only physical cores that divide evenly across the sockets are counted as free
+        self.count_mask = (1 << ((cores // sockets) * sockets)) - 1 if sockets else 0
+        self.socket_masks = [0] * sockets
+        for c in range(cores):
+            self.socket_masks[self.Socket(c)] |= 1 << c
 
-    def SetSibling(self, sib):
-        self.sibling = sib
+    @staticmethod
+    def PopCount(m: int) -> int:
+        return bin(m).count('1')
+
+    def Socket(self, c: int) -> int:
+        """ Gets the socket a logical core is on """
+        return int(int(c % self.phys_cores) // (self.phys_cores/self.sockets))
+
+    def Sibling(self, c: int) -> int:
+        """ Gets the SMT sibling of a logical core, or -1 if SMT is disabled """
+        if not self.smt:
+            return -1
+
+        return (c + self.phys_cores) if c < self.phys_cores else (c - self.phys_cores)
+
+    def IsUsed(self, c: int) -> bool:
+        return bool((self.used >> c) & 1)
+
+    def SetUsed(self, c: int, used: bool):
+        if used:
+            self.used |= 1 << c
+        else:
+            self.used &= ~(1 << c)
+
+    def Reserve(self, c: int):
+        """ Reserves a core for the OS so it's never handed out """
+        self.reserved |= 1 << c
+        self.used |= 1 << c
+
+    def FreePhysMask(self) -> int:
+        """ Bitmap of physical cores that are completely free. With SMT on, both siblings must be unused """
+        busy = (self.used | (self.used >> self.phys_cores)) if self.smt else self.used
+        return ~busy & self.phys_mask
+
+    def FreeCounts(self) -> List[int]:
+        """ Number of free physical cores on each socket """
+        free = self.FreePhysMask() & self.count_mask
+        return [self.PopCount(free & sm) for sm in self.socket_masks]
+
+    def TotalCounts(self) -> List[int]:
+        """ Number of physical cores on each socket """
+        return [self.PopCount(self.count_mask & sm) for sm in self.socket_masks]
+
+    def GetFreeBatch(self, socket: int, num: int, smt: SMTSetting) -> List[int]:
+        """ Picks up to num free logical cores on a socket, in the same order as walking every logical core from lowest
+            to highest. Cores are only taken from fully free physical cores. If the request allows SMT, both siblings
+            of a physical core are handed out together. Otherwise the first thread of every free physical core is
+            handed out first, followed by the sibling threads of those same cores once there are no more. The cores
+            are not marked as used. """
+        cpus = []
+        avail = self.FreePhysMask() & self.socket_masks[socket]
+        free = avail
+        while free and num > 0:
+            low = free & -free
+            c = low.bit_length() - 1
+            free ^= low
+
+            if self.smt and smt == SMTSetting.SMT_ENABLED and num >= 2:
+                cpus.extend([c, self.Sibling(c)])
+                num -= 2
+            else:
+                cpus.append(c)
+                num -= 1
+
+        if self.smt and smt != SMTSetting.SMT_ENABLED:
+            free = avail
+            while free and num > 0:
+                low = free & -free
+                free ^= low
+                cpus.append(self.Sibling(low.bit_length() - 1))
+                num -= 1
+
+        return cpus
 
 """
 Properties of a NIC inside of a node
@@ -84,16 +167,55 @@ class NodeGpu:
 
         return GpuType.GPU_TYPE_NOT_SUPPORTED
 
+"""
+Ledger entry holding the physical resources a single pod was given on a node. Releasing a pod replays this entry
+instead of re-parsing the pod's configuration.
+"""
+class PodAllocation:
+    def __init__(self):
+        self.cores: List[int] = []
+        self.gpus: List[int] = []                       # GPU device IDs
+        self.nics: List[Tuple[int, float, float]] = []  # (NIC index, rx speed, tx speed)
+        self.nic_pods: List[int] = []                   # NIC indices where this pod was counted as a user
+        self.hugepages_gb = 0
+
+    def ToDict(self) -> Dict:
+        return {'cores': self.cores, 'gpus': self.gpus, 'nics': [list(n) for n in self.nics], 'nic_pods': self.nic_pods,
+                'hugepages': self.hugepages_gb}
+
+    @staticmethod
+    def FromDict(d: Dict):
+        a = PodAllocation()
+        a.cores = list(d['cores'])
+        a.gpus = list(d['gpus'])
+        a.nics = [tuple(n) for n in d['nics']]
+        a.nic_pods = list(d['nic_pods'])
+        a.hugepages_gb = d['hugepages']
+        return a
+
+"""
+Immutable copy of a node's free resources, as gathered for the matcher. Being a plain tuple of tuples, it can be
+handed to a worker process without copying the rest of the node.
+"""
+class NodeFreeState(NamedTuple):
+    name: str
+    smt_enabled: bool
+    gpus: Tuple[int, ...]                               # Free GPUs per NUMA node
+    cpus: Tuple[int, ...]                               # Free physical cores per NUMA node
+    nics: Tuple[Tuple[Tuple[float, float], ...], ...]   # Free (rx, tx) per NIC, per NUMA node
+
 """
 The Node class holds properties about a node's resources, as well as which resources have been used.
 Current resource types in a node are CPUs, GPU, and NICs.
 """
 class Node:
+    versions = count(1) # Shared by every node, so a node recreated under the same name never reuses a version
+
     def __init__(self, name):
         self.logger = NHDCommon.GetLogger(__name__)
 
         self.name = name
-        self.cores: List[NodeCore] = []
+        self.cpus: NodeCpuMap = NodeCpuMap(0, 0, False)
         self.gpus = []
         self.nics = []
 
@@ -107,25 +229,54 @@ class Node:
         self.gwip : str = '0.0.0.0/32'
         self.mem: NodeMemory = NodeMemory()
         self.reserved_cores = [] # Reserved CPU cores
-
-    def ResetResources(self):
-        """ Resets all resources back to initial values """
-        self.logger.info(f'Node {self.name} resetting resources')
-
-        for c in self.cores:
-            if c.core not in self.reserved_cores:
-                c.used = False
-
-        for g in self.gpus:
-            g.used = False
-
-        for n in self.nics:
-            n.pods_used = 0
-            n.speed_used = [0,0]
-
-        self.mem.free_hugepages_gb = self.mem.ttl_hugepages_gb
-
-        self.pods_scheduled.clear()
+        self.pod_ledger: Dict[Tuple[str,str], PodAllocation] = {} # Resources held by each pod, keyed by (pod, ns)
+        self.free_gpus: List[List[int]] = []  # Positions in self.gpus of the free GPUs on each NUMA node, in order
+
+        # Lookup indexes into self.nics and self.gpus, rebuilt whenever the hardware is (re)initialized
+        self.nic_by_mac: Dict[str, int] = {}
+        self.nic_by_ifname: Dict[str, int] = {}
+        self.nic_by_numa_idx: Dict[Tuple[int,int], int] = {} # (NUMA node, per-NUMA NIC index) -> NIC position
+        self.gpu_by_id: Dict[int, int] = {}                   # Device ID -> GPU position
+
+        # Changes whenever any resource on the node is claimed, released, or reinitialized. Anything computed from the
+        # node's free resources is still valid as long as the version hasn't changed
+        self.state_version = next(Node.versions)
+
+    def Touch(self):
+        """ Bumps the state version after a change to the node's resources """
+        self.state_version = next(Node.versions)
+
+    def RebuildIndexes(self):
+        """ Rebuilds the NIC and GPU lookup indexes and the per-NUMA free GPU lists from scratch. Only needed when the
+            hardware is (re)initialized; every other change to a GPU goes through SetGpuUsed. Free cores are counted
+            straight from the CPU bitmaps """
+        self.nic_by_mac = {n.mac: i for i,n in enumerate(self.nics)}
+        self.nic_by_ifname = {n.ifname: i for i,n in enumerate(self.nics)}
+        self.nic_by_numa_idx = {(n.numa_node, n.idx): i for i,n in enumerate(self.nics)}
+        self.gpu_by_id = {g.device_id: i for i,g in enumerate(self.gpus)}
+
+        self.free_gpus = [[] for _ in range(self.numa_nodes)]
+        for i,g in enumerate(self.gpus):
+            if not g.used:
+                self.free_gpus[g.numa_node].append(i)
+
+    def SetCoreUsed(self, c: int, used: bool):
+        """ Marks a logical core as used or free """
+        self.cpus.SetUsed(c, used)
+        self.Touch()
+
+    def SetGpuUsed(self, gpu: NodeGpu, used: bool):
+        """ Marks a GPU as used or free, keeping the per-NUMA free GPU lists up to date """
+        if gpu.used == used:
+            return
+
+        self.Touch()
+        gpu.used = used
+        pos = self.gpu_by_id[gpu.device_id]
+        if used:
+            self.free_gpus[gpu.numa_node].remove(pos)
+        else:
+            insort(self.free_gpus[gpu.numa_node], pos)
 
     def GetTotalHugepages(self):
         """ Gets the total hugepages for a node """
@@ -135,12 +286,14 @@ class Node:
         """ Gets the free hugepages for a node """
         return self.mem.free_hugepages_gb        
 
+    def GetLedgerHugepages(self) -> int:
+        """ Gets the hugepages held by every pod in the ledger """
+        return sum(a.hugepages_gb for a in self.pod_ledger.values())
+
     def GetNIC(self, mac):
         """ Gets a NIC by MAC address """
-        for n in self.nics:
-            if n.mac == mac:
-                return n
-        return None
+        idx = self.nic_by_mac.get(mac)
+        return self.nics[idx] if idx is not None else None
 
     def GetNICUsedSpeeds(self):
         """ Gets the RX and TX speeds used on each NIC """
@@ -152,10 +305,8 @@ class Node:
 
     def GetNICFromIfName(self, ifname):
         """ Gets a NIC object from the interface name """
-        for n in self.nics:
-            if n.ifname == ifname:
-                return n
-        return None
+        idx = self.nic_by_ifname.get(ifname)
+        return self.nics[idx] if idx is not None else None
 
     def GetTotalPods(self):
         """ Gets the total pods scheduled on the node """
@@ -173,12 +324,144 @@ class Node:
         """ Remove a scheduled pod from the node """
         self.pods_scheduled.remove((pod,ns))
 
+    def GetPodAllocation(self, pod, ns) -> PodAllocation:
+        """ Gets the ledger entry for a pod, creating it if it doesn't exist yet """
+        if (pod, ns) not in self.pod_ledger:
+            self.pod_ledger[(pod, ns)] = PodAllocation()
+
+        return self.pod_ledger[(pod, ns)]
+
+    def ReleaseAllocation(self, alloc: PodAllocation):
+        """ Gives back every resource recorded in a ledger entry """
+        self.Touch()
+        for c in alloc.cores:
+            if not self.cpus.IsUsed(c):
+                self.logger.error(f'Core {c} was not in use!')
+            self.SetCoreUsed(c, False)
+
+        for g in alloc.gpus:
+            dev = self.GetGPU(g)
+            if dev is None:
+                self.logger.error(f'Cannot find GPU device ID {g}')
+                continue
+
+            if not dev.used:
+                self.logger.error(f'GPU {g} was not in use!')
+            self.SetGpuUsed(dev, False)
+
+        for (idx, rx, tx) in alloc.nics:
+            self.nics[idx].speed_used[0] -= rx
+            self.nics[idx].speed_used[1] -= tx
+
+        for idx in alloc.nic_pods:
+            self.nics[idx].pods_used -= 1
+
+        if alloc.hugepages_gb > 0:
+            self.mem.free_hugepages_gb += alloc.hugepages_gb
+            self.logger.info(f'Adding {alloc.hugepages_gb} 1GB hugepages to node. {self.mem.free_hugepages_gb} remaining')
+
+    def GetHardwareId(self) -> List:
+        """ Summary of the node's hardware layout. Ledger entries refer to cores, GPUs and NICs by position, so they can
+            only be carried over to a node with the same layout """
+        return [self.cpus.phys_cores, self.sockets, self.smt_enabled, self.reserved_cores,
+                [[n.mac, n.speed, n.numa_node] for n in self.nics], [[g.device_id, g.numa_node] for g in self.gpus]]
+
+    def RefreshLabels(self, labels):
+        """ Re-reads the node's NFD labels after they changed. If the hardware layout is the same, only the network
+            settings are updated. Otherwise the cores, GPUs and NICs are re-initialized from the labels and every pod's
+            ledger entry is replayed on top, so everything in use stays in use. Returns the pods whose resources no
+            longer exist on the node and were dropped from the ledger, or None if the labels can't be parsed, in which
+            case nothing is changed. """
+        fresh = Node(self.name)
+        if not fresh.ParseLabels(labels):
+            return None
+
+        self.data_vlan = fresh.data_vlan
+        self.gwip = fresh.gwip
+        if fresh.GetHardwareId() == self.GetHardwareId():
+            return []
+
+        self.logger.warning(f'Hardware on node {self.name} changed. Re-initializing and replaying {len(self.pod_ledger)} pods')
+        self.cpus = fresh.cpus
+        self.sockets = fresh.sockets
+        self.numa_nodes = fresh.numa_nodes
+        self.smt_enabled = fresh.smt_enabled
+        self.cores_per_proc = fresh.cores_per_proc
+        self.reserved_cores = fresh.reserved_cores
+        self.sriov_en = fresh.sriov_en
+        self.nics = fresh.nics
+        self.gpus = fresh.gpus
+        self.RebuildIndexes()
+
+        ledger = self.pod_ledger
+        scheduled = self.pods_scheduled
+        self.pod_ledger = {}
+        self.pods_scheduled = set()
+        self.mem.free_hugepages_gb = self.mem.ttl_hugepages_gb
+        self.Touch()
+
+        dropped = []
+        for (pod, ns), alloc in ledger.items():
+            if not self.RestoreAllocation(pod, ns, alloc):
+                self.logger.error(f'Resources of pod {ns}.{pod} no longer exist on node {self.name}. Dropping from ledger')
+                dropped.append((pod, ns))
+
+        # Pods whose placement is still being written are in the ledger without being scheduled yet
+        self.pods_scheduled = {p for p in scheduled if p in self.pod_ledger}
+        return dropped
+
+    def RestoreAllocation(self, pod, ns, alloc: PodAllocation) -> bool:
+        """ Takes the resources in a ledger entry saved earlier, and records it as the pod's entry. Nothing is taken if
+            any of the resources don't exist or are already in use. Hugepages are taken too, but the free count should
+            be refreshed from the API server afterwards. """
+        if (pod, ns) in self.pod_ledger:
+            return False
+
+        if any(c < 0 or c >= self.cpus.num_cores or self.cpus.IsUsed(c) for c in alloc.cores):
+            return False
+
+        if any(g not in self.gpu_by_id or self.gpus[self.gpu_by_id[g]].used for g in alloc.gpus):
+            return False
+
+        if any(i < 0 or i >= len(self.nics) for i in [n[0] for n in alloc.nics] + alloc.nic_pods):
+            return False
+
+        self.Touch()
+        for c in alloc.cores:
+            self.SetCoreUsed(c, True)
+
+        for g in alloc.gpus:
+            self.SetGpuUsed(self.gpus[self.gpu_by_id[g]], True)
+
+        for (idx, rx, tx) in alloc.nics:
+            self.nics[idx].speed_used[0] += rx
+            self.nics[idx].speed_used[1] += tx
+
+        for idx in alloc.nic_pods:
+            self.nics[idx].pods_used += 1
+
+        self.mem.free_hugepages_gb -= alloc.hugepages_gb
+        self.pod_ledger[(pod, ns)] = alloc
+        self.pods_scheduled.add((pod, ns))
+        return True
+
+    def ReleasePodResources(self, pod, ns) -> bool:
+        """ Frees all resources held by a pod using the ledger. Returns False if the pod holds nothing on this node """
+        alloc = self.pod_ledger.pop((pod, ns), None)
+        if alloc is None:
+            return False
+
+        self.logger.info(f'Releasing cores={alloc.cores}, gpus={alloc.gpus}, nics={alloc.nics}, hugepages={alloc.hugepages_gb} '
+                         f'from pod {ns}.{pod} on node {self.name}')
+        self.ReleaseAllocation(alloc)
+        self.pods_scheduled.discard((pod, ns))
+
+        return True
+
     def GetGPU(self, di):
         """ Gets a GPU by device ID """
-        for g in self.gpus:
-            if g.device_id == di:
-                return g
-        return None
+        idx = self.gpu_by_id.get(di)
+        return self.gpus[idx] if idx is not None else None
 
     def SMTEnabled(self) -> bool:
         """ Determine if SMT is enabled for this node """
@@ -188,14 +471,11 @@ class Node:
         """ Gets the number of free CPU cores available. If SMT is enabled we only count cores where both
             siblings are unused.
         """
-        if self.smt_enabled:
-            return len([x for x in self.cores if not x.used and not self.cores[x.sibling].used])
-        else:        
-            return len([x for x in self.cores if not x.used])
+        return sum(self.cpus.FreeCounts()) * (2 if self.smt_enabled else 1)
 
     def GetFreeGpuCount(self) -> int:
         """ Gets the number of free GPUs """
-        return len([x for x in self.gpus if not x.used])
+        return sum(len(x) for x in self.free_gpus)
 
     def GetTotalGPUs(self) -> int:
         """ Gets the total number of GPUs in the node """
@@ -203,23 +483,13 @@ class Node:
 
     def GetTotalCPUs(self) -> int:
         """ Gets the total number of CPUs on the node """
-        return len(self.cores)
+        return self.cpus.num_cores
 
     def GetFreeCpuCores(self) -> int:
         """ Returns a list containing a list for each socket specifying how many cores + siblings are free. Note that
             we do not allow any multi-tenancy on cores which are already partially used (SMT on and 1/2 logical cores
             are used). """
-        self.logger.info(f'Searching for free CPU cores on node {self.name}')
-
-        fl = [0] * self.numa_nodes
-        for c in range(self.cores_per_proc*self.sockets):
-            if not self.cores[c].used:
-                if not self.smt_enabled:
-                    fl[self.cores[c].socket] += 1 # Fix in future if we use AMD or other weirdos
-                elif not self.cores[self.cores[c].sibling].used:
-                    fl[self.cores[c].socket] += 1
-    
-        return fl
+        return self.cpus.FreeCounts()
 
     def GetFreeNumaNicResources(self) -> List[int]:
         """ Return the amount of free NIC resources per NUMA node """
@@ -262,16 +532,7 @@ class Node:
         self.cores_per_proc = cores // self.sockets
 
         self.logger.info(f'Initializing CPUs for node {self.name} with procs={self.sockets}, cores={cores}, smt={self.smt_enabled}')
-        self.cores = [None]*cores if not self.smt_enabled else [None]*cores*2
-
-        for c in range(len(self.cores)):
-            proc = int(int(c % cores) // (cores/self.sockets))
-            if self.smt_enabled:
-                sib = (c + cores) if c < cores else (c - cores)
-            else:
-                sib = -1
-
-            self.cores[c] = NodeCore(c, proc, sib)
+        self.cpus = NodeCpuMap(cores, self.sockets, self.smt_enabled)
 
         if 'feature.node.kubernetes.io/nfd-extras-cpu.isolcpus' not in labels:
             self.logger.info(f'No isolated CPU information found for node {self.name}')
@@ -282,15 +543,15 @@ class Node:
             for r in isolrange:
                 isolcores.extend(Node.ParseRangeList(r))
             self.logger.info(f'Isolated cores in node {self.name} read as {isolrange}')
-            ttlcores   = list(range(0, len(self.cores)))
+            ttlcores   = list(range(0, self.cpus.num_cores))
 
             nonisol = list(set(ttlcores) - set(isolcores))
 
             # Mark all OS reserved cores as in use
             self.logger.info(f'Marking cores {nonisol} as used')
-            for c in range(len(self.cores)):
+            for c in range(self.cpus.num_cores):
                 if c in nonisol:
-                    self.cores[c].used = True
+                    self.cpus.Reserve(c)
                     self.reserved_cores.append(c)
 
 
@@ -404,18 +665,29 @@ class Node:
         return True
 
     def GetFreeNumaGPUs(self):
-        gfree = [0] * self.numa_nodes
-        for g in self.gpus:
-            if not g.used:
-                gfree[g.numa_node] += 1
-        
-        return gfree
+        return [len(x) for x in self.free_gpus]
+
+    def MayFit(self, demand: Dict) -> bool:
+        """ Quick check of whether the node has enough free resources of each kind for a topology's total demand, as
+            returned by CfgTopology.GetTotalDemand. Passing doesn't guarantee the NUMA placement will work """
+        if self.GetFreeGpuCount() < demand['gpu'] or self.GetFreeCpuCoreCount() < demand['cpu'] or \
+           self.mem.free_hugepages_gb < demand['hugepages']:
+            return False
+
+        free = [r for numa in self.GetFreeNumaNicResources() for r in numa]
+        return all(any(r[0] >= d[0] and r[1] >= d[1] for r in free) for d in demand['nic'])
+
+    def GetFreeState(self) -> NodeFreeState:
+        """ Takes an immutable snapshot of the node's free resources for the matcher """
+        return NodeFreeState(self.name, self.SMTEnabled(), tuple(self.GetFreeNumaGPUs()), tuple(self.GetFreeCpuCores()),
+                             tuple(tuple(tuple(r) for r in numa) for numa in self.GetFreeNumaNicResources()))
 
     def SetNodeAddr(self, addr):
         self.logger.info(f'Setting node {self.name} address to {addr}')
         self.addr = addr
 
     def ParseLabels(self, labels):
+        self.Touch()
         if not self.InitCores(labels):
             return False
 
@@ -428,39 +700,24 @@ class Node:
         if not self.InitMisc(labels):
             return False
 
+        self.RebuildIndexes()
         return True
 
     def SetHugepages(self, alloc: int, free: int) -> bool: 
+        self.Touch()
         self.mem.ttl_hugepages_gb  = alloc
         self.mem.free_hugepages_gb = free
         self.logger.info(f'Found {self.mem.free_hugepages_gb}/{self.mem.ttl_hugepages_gb}GB of hugepages allocatable/capacity on node {self.name}')
         return True
 
     def GetNextGpuFree(self, numa):
-        for g in self.gpus:
-            if g.numa_node == numa and not g.used:
-                return g
+        if numa >= len(self.free_gpus) or not self.free_gpus[numa]:
+            return None
 
-        return None                    
+        return self.gpus[self.free_gpus[numa][0]]
      
     def GetFreeCpuBatch(self, numa: int, num: int, smt: SMTSetting) -> List[int]:
-        cpus = []
-        for ci,c in enumerate(self.cores):
-            if num == 0:
-                break
-            if c.socket == numa and not c.used:
-                if self.smt_enabled:
-                    if not self.cores[c.sibling].used: # Switch to numa instead of socket later
-                        if smt == SMTSetting.SMT_ENABLED and num >= 2:
-                            cpus.extend([c.core, c.sibling])
-                            num -= 2
-                        else:
-                            cpus.append(c.core)
-                            num -= 1
-                else:
-                    cpus.append(c.core)
-                    num -= 1
-        return cpus  
+        return self.cpus.GetFreeBatch(numa, num, smt) # Switch to numa instead of socket later
 
     def PrintResourceStats(self):
         self.logger.info(f'Node {self.name} resource stats:')
@@ -473,19 +730,24 @@ class Node:
         
 
 
-    def RemoveResourcesFromTopology(self, top):
-        """ Remove resources from a node that are present in a topology structure. """
+    def RemoveResourcesFromTopology(self, top, pod=None, ns=None):
+        """ Remove resources from a node that are present in a topology structure. If a pod is given, the resources
+            are recorded in the pod's ledger entry so they can be released later without the topology. """
+        alloc = self.GetPodAllocation(pod, ns) if pod is not None else PodAllocation()
+        self.Touch()
+
+        def take_core(c, desc):
+            if self.cpus.IsUsed(c):
+                self.logger.error(f'{desc} {c} was already in use!')
+            self.SetCoreUsed(c, True)
+            alloc.cores.append(c)
 
         for pv in top.proc_groups:
             for m in pv.misc_cores:
-                if self.cores[m.core].used:
-                    self.logger.error(f'Processing group misc core {m.core} was already in use!')
-                self.cores[m.core].used = True
+                take_core(m.core, 'Processing group misc core')
 
             for m in pv.proc_cores:
-                if self.cores[m.core].used:
-                    self.logger.error(f'Processing group core {m.core} was already in use!')
-                self.cores[m.core].used = True
+                take_core(m.core, 'Processing group core')
 
             for g in pv.group_gpus:
                 dev = self.GetGPU(g.device_id)
@@ -496,23 +758,22 @@ class Node:
                         self.logger.error(f'GPU {dev.device_id} was already in use!')
 
                     self.logger.info(f'Taking GPU device ID {g.device_id}')
-                    dev.used = True
+                    self.SetGpuUsed(dev, True)
+                    alloc.gpus.append(dev.device_id)
 
                 for c in g.cpu_cores:
-                    if self.cores[c.core].used:
-                        self.logger.error(f'GPU core {c.core} was already in use!')
-                    self.cores[c.core].used = True
+                    take_core(c.core, 'GPU core')
 
         for m in top.misc_cores:
-            if self.cores[m.core].used:
-                self.logger.error(f'Miscellaneous core {m.core} was already in use!')
-            self.cores[m.core].used = True
+            take_core(m.core, 'Miscellaneous core')
 
         for p in top.nic_core_pairing:
-            nic = self.GetNIC(p.mac) if not self.sriov_en else self.GetNICFromIfName(p.mac)
-            if nic is None:
+            nidx = self.nic_by_mac.get(p.mac) if not self.sriov_en else self.nic_by_ifname.get(p.mac)
+            if nidx is None:
                 self.logger.error(f'Cannot find NIC {p.mac} on node!')
                 continue
+
+            nic = self.nics[nidx]
             
             nic.speed_used[0] += p.rx_core.nic_speed
             nic.speed_used[1] += p.tx_core.nic_speed
@@ -520,62 +781,15 @@ class Node:
 
             nic.pods_used += 1
 
+            alloc.nics.append((nidx, p.rx_core.nic_speed, p.tx_core.nic_speed))
+            alloc.nic_pods.append(nidx)
+
         if top.hugepages_gb > 0:
             self.mem.free_hugepages_gb -= top.hugepages_gb    
+            alloc.hugepages_gb += top.hugepages_gb
             self.logger.info(f'Taking {top.hugepages_gb} 1GB hugepages from node. {self.mem.free_hugepages_gb} remaining')                  
 
 
-    def AddResourcesFromTopology(self, top):
-        """ Add resources from a node that are present in a topology structure. """
-
-        for pv in top.proc_groups:
-            for m in pv.misc_cores:
-                if not self.cores[m.core].used:
-                    self.logger.error(f'Processing misc core {m.core} was not in use!')
-                self.cores[m.core].used = False
-
-            for m in pv.proc_cores:
-                if not self.cores[m.core].used:
-                    self.logger.error(f'Processing core {m.core} was not in use!')
-                self.cores[m.core].used = False
-
-            for g in pv.group_gpus:
-                dev = self.GetGPU(g.device_id)
-                if dev is None:
-                    self.logger.error(f'Cannot find GPU device ID {g.device_id}')
-                else:
-                    if not dev.used:
-                        self.logger.error(f'GPU {dev.device_id} was not in use!')
-
-                    dev.used = False
-
-                for c in g.cpu_cores:
-                    if not self.cores[c.core].used:
-                        self.logger.error(f'GPU core {c.core} was not in use!')
-                    self.cores[c.core].used = False
-
-        for m in top.misc_cores:
-            if not self.cores[m.core].used:
-                self.logger.error(f'Misc core {m.core} was not in use!')
-            self.cores[m.core].used = False
-
-        for p in top.nic_core_pairing:
-            nic = self.GetNIC(p.mac) if not self.sriov_en else self.GetNICFromIfName(p.mac)
-            if nic is None:
-                self.logger.error(f'Cannot find NIC {p.mac} on node!')
-                continue
-            
-            nic.speed_used[0] -= p.rx_core.nic_speed
-            nic.speed_used[1] -= p.tx_core.nic_speed
-            self.logger.info(f'Speeds used on NIC after adding resources = {nic.speed_used[0]}/{nic.speed_used[1]}')
-
-            nic.pods_used -= 1
-
-        # Hugepages requests
-        if top.hugepages_gb > 0:
-            self.mem.free_hugepages_gb += top.hugepages_gb    
-            self.logger.info(f'Adding {top.hugepages_gb} 1GB hugepages to node. {self.mem.free_hugepages_gb} remaining')                    
-    
     def GetNADListFromIndices(self, ilist: List[int]):
         """ Get the NAD list from the NIC indices """
         names = [self.nics[i].ifname for i in ilist]
@@ -583,18 +797,24 @@ class Node:
         return names
 
 
-    def ClaimPodNICResources(self, nidx):
+    def ClaimPodNICResources(self, nidx, pod, ns):
+        alloc = self.GetPodAllocation(pod, ns)
+        self.Touch()
         for ni in nidx: # Mark as pod using the interface
             self.nics[ni].pods_used += 1
+            alloc.nic_pods.append(ni)
 
-    def SetPhysicalIdsFromMapping(self, mapping, top: CfgTopology):
+    def SetPhysicalIdsFromMapping(self, mapping, top: CfgTopology, pod, ns):
         """ Maps the indices after the mapping function is done into physical node resources based on what's free. Uses
-            the previously-defined topology to pull the actual groups out """
+            the previously-defined topology to pull the actual groups out. Everything handed out is recorded in the
+            pod's ledger entry. """
         
         # Set up the "used" resources.
         used_cpus = []
         used_gpus = []
         used_nics = []
+        alloc = self.GetPodAllocation(pod, ns)
+        self.Touch()
         
         try:
             # Go through each of the processing groups and map resources
@@ -623,28 +843,27 @@ class Node:
                     self.logger.info(f'Got GPU with device ID {gdev.device_id}')                        
                     
                     gv.device_id = gdev.device_id
-                    gdev.used = True
+                    self.SetGpuUsed(gdev, True)
                     used_gpus.append(gdev.device_id)
+                    alloc.gpus.append(gdev.device_id)
 
                     for gpu_cpu in gv.cpu_cores:
                         gpu_cpu.core = group_cpus[cidx]
-                        self.cores[gpu_cpu.core].used = True
+                        self.SetCoreUsed(gpu_cpu.core, True)
+                        alloc.cores.append(gpu_cpu.core)
                         cidx += 1
 
                 # Assign processing cores
                 for groupc in pv.proc_cores:
                     groupc.core = group_cpus[cidx]
-                    self.cores[groupc.core].used = True
+                    self.SetCoreUsed(groupc.core, True)
+                    alloc.cores.append(groupc.core)
                     cidx += 1
 
                     # Check if this core is using NIC resources
                     if groupc.nic_dir in (NICCoreDirection.NIC_CORE_DIRECTION_RX, NICCoreDirection.NIC_CORE_DIRECTION_TX):
                         nicmap = mapping['nic'][pi][1]
-                        idx = -1
-                        for ni, nic in enumerate(self.nics):
-                            if nicmap == nic.idx and nic.numa_node == group_numa_node:
-                                idx = ni
-                                break
+                        idx = self.nic_by_numa_idx.get((group_numa_node, nicmap), -1)
 
                         if idx == -1:
                             self.logger.error(f'Couldn\'t find NIC index for NUMA node {group_numa_node} on node')
@@ -653,6 +872,7 @@ class Node:
                             sidx = 0 if groupc.nic_dir == NICCoreDirection.NIC_CORE_DIRECTION_RX else 1
                             self.nics[idx].speed_used[sidx] += groupc.nic_speed
                             used_nics.append((idx, groupc.nic_speed, groupc.nic_dir))
+                            alloc.nics.append((idx, groupc.nic_speed if sidx == 0 else 0, groupc.nic_speed if sidx == 1 else 0))
 
                         # Set physical NIC resources
                         ng = top.GetNICGroup(groupc)
@@ -680,16 +900,17 @@ class Node:
                 cidx = 0
                 if len(pv.misc_cores) != len(helper_req):
                     self.logger.error(f'Asked for {len(pv.misc_cores)} free helper CPUs, but only got {len(helper_req)} back!')
-                    return None
+                    raise IndexError
 
                 for hc in pv.misc_cores:
                     hc.core = helper_req[cidx]
-                    self.cores[hc.core].used = True
+                    self.SetCoreUsed(hc.core, True)
+                    alloc.cores.append(hc.core)
                     cidx += 1
 
                 if cidx != len(helper_req):
                     self.logger.info('Still have {len(helper_req) - cidx} leftover helper CPUs in request list!')
-                    return None
+                    raise IndexError
                     
                 used_cpus.extend(helper_req)
 
@@ -699,6 +920,7 @@ class Node:
             # Hugepages requests
             if top.hugepages_gb > 0:
                 self.mem.free_hugepages_gb -= top.hugepages_gb    
+                alloc.hugepages_gb += top.hugepages_gb
                 self.logger.info(f'Taking {top.hugepages_gb} 1GB hugepages from node. {self.mem.free_hugepages_gb} remaining')                    
 
             # Last, we assign the top-level miscellaneous cores. Miscellaneous cores are the last element in the CPU list
@@ -708,16 +930,17 @@ class Node:
             cidx = 0
             if len(top.misc_cores) != len(misc_cpus):
                 self.logger.error(f'Asked for {top.misc_cores} free helper CPUs, but only got {len(misc_cpus)} back!')
-                return None
+                raise IndexError
 
             for mc in top.misc_cores:
                 mc.core = misc_cpus[cidx]
-                self.cores[mc.core].used = True
+                self.SetCoreUsed(mc.core, True)
+                alloc.cores.append(mc.core)
                 cidx += 1
 
             if cidx != len(misc_cpus):
                 self.logger.info('Still have {len(misc_cpus) - cidx} leftover helper CPUs in request list!')
-                return None
+                raise IndexError
 
             used_cpus.extend(misc_cpus)
 
@@ -731,16 +954,7 @@ class Node:
 
         except IndexError:
             self.logger.info('One or more failures assigning resources to node. Unwinding mapping and returning...')
-            for c in used_cpus:
-                self.cores[c].used = False
-            for g in used_gpus:
-                self.gpus[g].used = False
-            for n in used_nics:
-                if n[2] == NICCoreDirection.NIC_CORE_DIRECTION_RX:
-                    self.nics[n[0]].speed_used[0] -= self.nics[n[1]]
-                else:
-                    self.nics[n[0]].speed_used[1] -= self.nics[n[1]]
-            
+            self.ReleasePodResources(pod, ns)
             raise
         
         self.logger.info(f'Node {self.name} has {self.GetFreeCpuCoreCount()} CPU cores and {self.GetFreeGpuCount()} free GPUs left')
@@ -0,0 +1,156 @@
+import os
+from enum import Enum
+from nhd.NHDCommon import NHDCommon
+from typing import Dict, List, Tuple
+
+SCORE_STRATEGY_ENV          = 'NHD_SCORE_STRATEGY'                    # Environment variable selecting the deployment-wide strategy
+SCORE_STRATEGY_ANNOTATION   = 'sigproc.viasat.io/nhd_score_strategy'  # Pod annotation overriding the strategy for one pod
+
+
+class ScoreStrategy(Enum):
+    SCORE_STRATEGY_BEST_FIT         = 'best-fit'
+    SCORE_STRATEGY_LEAST_STRANDED   = 'least-stranded'
+    SCORE_STRATEGY_SPREAD           = 'spread'
+
+DEFAULT_SCORE_STRATEGY = ScoreStrategy.SCORE_STRATEGY_BEST_FIT
+
+
+"""
+Scores every (node, NUMA mapping) combination that survived filtering and picks the best one. Each candidate is
+first reduced to what the node would have left over if the pod were placed with that mapping, and the strategy
+is then applied to those leftovers in a single pass over all candidates.
+
+Strategies:
+    best-fit        Pack pods onto the fullest node that fits, using the mapping that consumes the least and keeps
+                    whatever is left concentrated on as few NUMA nodes as possible.
+    least-stranded  Avoid leaving GPUs behind on NUMA nodes that no longer have the cores or NICs to use them, and
+                    keep GPU and CPU usage balanced within each NUMA node. Ties fall back to best-fit.
+    spread          Place pods on the emptiest node that fits, using the mapping that consumes the least.
+"""
+class NodeScorer:
+    def __init__(self):
+        self.logger = NHDCommon.GetLogger(__name__)
+
+        env = os.environ.get(SCORE_STRATEGY_ENV, '')
+        self.default = self.ParseStrategy(env) if env != '' else DEFAULT_SCORE_STRATEGY
+        if self.default is None:
+            self.logger.warning(f'Unknown scoring strategy "{env}" in {SCORE_STRATEGY_ENV}. Using {DEFAULT_SCORE_STRATEGY.value}')
+            self.default = DEFAULT_SCORE_STRATEGY
+
+        self.logger.info(f'Default node scoring strategy is {self.default.value}')
+
+    @staticmethod
+    def ParseStrategy(name: str) -> ScoreStrategy:
+        """ Converts a strategy name from an annotation or the environment into a ScoreStrategy. Returns None if
+            the name isn't recognized """
+        for s in ScoreStrategy:
+            if s.value == name.strip().lower():
+                return s
+
+        return None
+
+    def GetStrategy(self, name: str = None) -> ScoreStrategy:
+        """ Returns the strategy to use for a pod, given the value of its strategy annotation (if any) """
+        if name is None or name == '':
+            return self.default
+
+        s = self.ParseStrategy(name)
+        if s is None:
+            self.logger.warning(f'Unknown scoring strategy "{name}" requested by pod. Using {self.default.value}')
+            return self.default
+
+        return s
+
+    @staticmethod
+    def GetLeftovers(node, free: Dict, combo: Dict) -> Tuple:
+        """ Computes what a node would have left if the pod were placed with the given combo. free holds the free
+            resources and per-group demands the matcher already gathered for this node. Returns a tuple of per-NUMA
+            (free, left, total) lists for each of GPUs, cores and NICs, where free is before the pod is placed and left
+            is after. """
+        numa_nodes = len(free['gpu'])
+
+        gleft = list(free['gpu'])
+        for gi,n in enumerate(combo['gpu']):
+            gleft[n] -= free['gpu_req'][gi]
+
+        cleft = list(free['cpu'])
+        for gi,n in enumerate(combo['cpu']):
+            cleft[n] -= free['cpu_req'][gi]
+
+        # With sharing disabled any NIC we touch is fully used, so only count NICs the pod doesn't land on
+        touched = set(combo['nic'])
+        nfree = [0] * numa_nodes
+        nleft = [0] * numa_nodes
+        for n in range(numa_nodes):
+            for ni,r in enumerate(free['nic'][n]):
+                if r[0] > 0 and r[1] > 0:
+                    nfree[n] += 1
+                    if (n, ni) not in touched:
+                        nleft[n] += 1
+
+        gtot = [0] * numa_nodes
+        for g in node.gpus:
+            gtot[g.numa_node] += 1
+
+        ctot = node.cpus.TotalCounts()
+
+        ntot = [len(x) for x in free['nic']]
+
+        return ((free['gpu'], gleft, gtot), (free['cpu'], cleft, ctot), (nfree, nleft, ntot))
+
+    @staticmethod
+    def LeftFraction(left: List[int], tot: List[int]) -> float:
+        """ Fraction of a resource left free across the whole node. Resources the node doesn't have don't count """
+        t = sum(tot)
+        return sum(left) / t if t > 0 else 0.0
+
+    def ScoreCandidate(self, strategy: ScoreStrategy, lo: Tuple) -> Tuple:
+        """ Scores a single candidate's leftovers. Higher is better, and scores are tuples so later entries act as
+            tie breakers. The GPUs and cores a pod uses are the same for every mapping on a node, so the node is
+            chosen on how full it is beforehand, while the mapping is chosen on what it leaves behind (mostly NICs,
+            since a pod can sometimes fit several groups on one NIC). """
+        before = sum(self.LeftFraction(f, t) for f,_,t in lo) / len(lo)
+        after  = sum(self.LeftFraction(l, t) for _,l,t in lo) / len(lo)
+
+        # Sum of squared per-NUMA free fractions. For the same amount left over, this is larger when the free
+        # resources are concentrated on fewer NUMA nodes, which is what lets later large pods fit
+        concentration = 0.0
+        for _,l,t in lo:
+            for n in range(len(t)):
+                if t[n] > 0:
+                    concentration += (l[n] / t[n]) ** 2
+
+        if strategy == ScoreStrategy.SCORE_STRATEGY_SPREAD:
+            return (before, after, concentration)
+
+        best_fit = (-before, after, concentration)
+        if strategy == ScoreStrategy.SCORE_STRATEGY_LEAST_STRANDED:
+            (_, gleft, gtot), (_, cleft, ctot), (_, nleft, ntot) = lo
+            stranded  = 0
+            imbalance = 0.0
+            for n in range(len(gtot)):
+                if gleft[n] > 0 and (cleft[n] == 0 or (ntot[n] > 0 and nleft[n] == 0)):
+                    stranded += gleft[n]
+                if gtot[n] > 0 and ctot[n] > 0:
+                    imbalance += abs(gleft[n] / gtot[n] - cleft[n] / ctot[n])
+
+            return (-stranded, -imbalance) + best_fit
+
+        return best_fit
+
+    def Select(self, nl: Dict, filts, strategy: ScoreStrategy) -> Tuple[str, Dict]:
+        """ Scores every combination of every candidate node and returns the (node, combo) with the highest score.
+            Ties go to the earliest candidate so the result is deterministic. """
+        res_cands, cand_nodes, free = filts
+
+        best, bscore = (None, None), None
+        for n in cand_nodes:
+            for c in res_cands[n]:
+                score = self.ScoreCandidate(strategy, self.GetLeftovers(nl[n], free[n], c))
+                if bscore is None or score > bscore:
+                    best, bscore = (n, c), score
+
+        if best[0] is not None:
+            self.logger.info(f'Strategy {strategy.value} selected node {best[0]} with score {bscore}')
+
+        return best
@@ -0,0 +1,263 @@
+from typing import Dict, Iterator, List, Tuple
+
+
+"""
+Solvers for placing a pod's processing groups onto the NUMA nodes of a machine. The naive approach of enumerating
+every way the groups can be assigned to NUMA nodes grows as numa_nodes^groups, so instead these answer feasibility
+with a memoized search over the remaining free resources, and only enumerate concrete mappings on demand.
+"""
+class NumaSolver:
+    @staticmethod
+    def Feasible(demands: List[int], free: List[int], memo: Dict = None) -> bool:
+        """ Determines whether the per-group demands can all be packed into the per-NUMA free counts, where each
+            group must fit entirely on a single NUMA node. NUMA nodes are interchangeable for the purpose of
+            feasibility, so the state is the sorted tuple of remaining free counts. Groups are placed largest first,
+            which lets most infeasible requests fail on the first few groups. """
+        if memo is None:
+            memo = {}
+
+        dem = tuple(sorted((d for d in demands if d > 0), reverse=True))
+        if sum(dem) > sum(free):
+            return False
+
+        def place(i, rem):
+            if i == len(dem):
+                return True
+
+            key = (i, rem)
+            if key in memo:
+                return memo[key]
+
+            ok = False
+            tried = set()
+            for ni,r in enumerate(rem):
+                if r < dem[i] or r in tried: # NUMA nodes with the same free count are equivalent
+                    continue
+
+                tried.add(r)
+                nrem = list(rem)
+                nrem[ni] -= dem[i]
+                if place(i+1, tuple(sorted(nrem, reverse=True))):
+                    ok = True
+                    break
+
+            memo[key] = ok
+            return ok
+
+        return place(0, tuple(sorted(free, reverse=True)))
+
+    @staticmethod
+    def PackNics(demands: List[List[float]], nics: List[List[float]]) -> bool:
+        """ Determines whether every (rx, tx) demand can be given a NIC out of the residual [rx, tx] capacities in
+            nics without oversubscribing any of them. Demands are placed largest first, and NICs with the same residual
+            capacity are only tried once. """
+        dem = sorted(demands, reverse=True)
+        free = [list(r) for r in nics]
+
+        def place(k):
+            if k == len(dem):
+                return True
+
+            tried = set()
+            for r in free:
+                if r[0] < dem[k][0] or r[1] < dem[k][1] or tuple(r) in tried:
+                    continue
+
+                tried.add(tuple(r))
+                r[0] -= dem[k][0]
+                r[1] -= dem[k][1]
+                ok = place(k+1)
+                r[0] += dem[k][0]
+                r[1] += dem[k][1]
+                if ok:
+                    return True
+
+            return False
+
+        return place(0)
+
+    @staticmethod
+    def NicAssignments(demands: List[List[float]], nic_free: List[List[List[float]]],
+                       numa_map: List[int] = None) -> Iterator[List[Tuple[int, int]]]:
+        """ Lazily yields every feasible assignment of each group's (rx, tx) bandwidth demand to a NIC, as a list of
+            (numa node, per-NUMA NIC index) per group. nic_free is the per-NUMA list of residual [rx, tx] capacity from
+            Node.GetFreeNumaNicResources. If numa_map is given, each group is only placed on NICs of the NUMA node it
+            maps to.
+
+            Groups are first assigned to NUMA nodes one at a time. Each time a group is added to a NUMA node, the groups
+            on that node must still pack into its NICs, and the bandwidth of the groups left to place must still fit in
+            what's left across all NUMA nodes, so a partial assignment is abandoned as soon as any NIC would be
+            oversubscribed. Partial assignments that led nowhere are remembered by the demands on each NUMA node, so
+            NUMA nodes with the same NICs and the same groups aren't searched again.
+
+            The assignments come out in the same order the original enumeration produced them: NUMA tuples in
+            itertools.product order, and for each one the NIC choices of the groups on NUMA 0 first, then NUMA 1, etc. """
+        res = [[list(x) for x in numa] for numa in nic_free]
+        numa_nodes = len(res)
+        fixed = numa_map
+        numa_map = []
+        on_numa = [[] for _ in range(numa_nodes)] # Demands of the groups placed on each NUMA node so far
+        spare = [[sum(r[0] for r in numa), sum(r[1] for r in numa)] for numa in res]
+        caps = [tuple(sorted(tuple(r) for r in numa)) for numa in res]
+        packs = {}
+        dead = set()
+
+        # Bandwidth still needed by group i and every group after it
+        left = [[0, 0] for _ in range(len(demands) + 1)]
+        for i in reversed(range(len(demands))):
+            left[i] = [left[i+1][0] + demands[i][0], left[i+1][1] + demands[i][1]]
+
+        def packable(n):
+            key = (caps[n], tuple(sorted(on_numa[n])))
+            if key not in packs:
+                packs[key] = NumaSolver.PackNics(on_numa[n], res[n])
+            return packs[key]
+
+        def assign_nics(order, k, choice):
+            if k == len(order):
+                yield [(numa_map[i], choice[i]) for i in range(len(demands))]
+                return
+
+            i = order[k]
+            for ni,r in enumerate(res[numa_map[i]]):
+                if r[0] < demands[i][0] or r[1] < demands[i][1]:
+                    continue
+
+                r[0] -= demands[i][0]
+                r[1] -= demands[i][1]
+                choice[i] = ni
+                yield from assign_nics(order, k+1, choice)
+                r[0] += demands[i][0]
+                r[1] += demands[i][1]
+
+        def assign_numa(i):
+            if i == len(demands):
+                order = sorted(range(len(demands)), key=lambda g: numa_map[g])
+                yield from assign_nics(order, 0, [0] * len(demands))
+                return
+
+            if left[i][0] > sum(x[0] for x in spare) or left[i][1] > sum(x[1] for x in spare):
+                return
+
+            # Without a fixed mapping, whether the rest of the groups fit only depends on what's on each NUMA node
+            state = None
+            if fixed is None:
+                state = (i, tuple(sorted((caps[n], tuple(sorted(on_numa[n]))) for n in range(numa_nodes))))
+                if state in dead:
+                    return
+
+            found = False
+            for n in (range(numa_nodes) if fixed is None else (fixed[i],)):
+                on_numa[n].append(tuple(demands[i]))
+                if packable(n):
+                    spare[n][0] -= demands[i][0]
+                    spare[n][1] -= demands[i][1]
+                    numa_map.append(n)
+                    for a in assign_numa(i+1):
+                        found = True
+                        yield a
+                    numa_map.pop()
+                    spare[n][0] += demands[i][0]
+                    spare[n][1] += demands[i][1]
+
+                on_numa[n].pop()
+
+            if not found and state is not None:
+                dead.add(state)
+
+        yield from assign_numa(0)
+
+    @staticmethod
+    def NicAssignment(demands: List[List[float]], nic_free: List[List[List[float]]],
+                      numa_map: List[int] = None) -> List[Tuple[int, int]]:
+        """ Returns the first feasible NIC assignment, or None if there isn't one """
+        return next(NumaSolver.NicAssignments(demands, nic_free, numa_map), None)
+
+    @staticmethod
+    def JointMappings(gpu_req: List[int], gpu_free: List[int], cpu_req: List[int], cpu_free: List[int],
+                      nic_req: List[List[float]], nic_free: List[List[List[float]]], limit: int = 0) -> Iterator[Dict]:
+        """ Searches group to NUMA node assignments checking GPUs, CPUs and NICs together, so a partial assignment is
+            dropped as soon as any one resource can't be met. cpu_req has one more entry than there are groups, which
+            holds the top-level miscellaneous cores that may go on any NUMA node.
+
+            Yields one combination per feasible group mapping, in itertools.product order, in the format the rest of
+            the matcher uses: {'gpu': (numa per group), 'cpu': (numa per group + misc numa), 'nic': [(numa, nic idx)]}.
+            The misc cores and NICs are given the first choice that fits. If limit is non-zero the search stops after
+            that many combinations. """
+        groups = len(gpu_req)
+        numa_nodes = len(gpu_free)
+        grem = list(gpu_free)
+        crem = list(cpu_free)
+        gmemo = {}
+        cmemo = {}
+        cur = []
+        found = 0
+
+        # NIC bandwidth is tracked the same way NicAssignments does it: the groups on each NUMA node must pack into its
+        # NICs, and the bandwidth still needed must fit in what's left across all NUMA nodes
+        on_numa = [[] for _ in range(numa_nodes)]
+        spare = [[sum(r[0] for r in numa), sum(r[1] for r in numa)] for numa in nic_free]
+        packs = {}
+        left = [[0, 0] for _ in range(groups + 1)]
+        for i in reversed(range(groups)):
+            left[i] = [left[i+1][0] + nic_req[i][0], left[i+1][1] + nic_req[i][1]]
+
+        def nic_packable(n):
+            key = (n, tuple(sorted(on_numa[n])))
+            if key not in packs:
+                packs[key] = NumaSolver.PackNics(on_numa[n], nic_free[n])
+            return packs[key]
+
+        def memo_for(memo, i):
+            if i not in memo:
+                memo[i] = {}
+            return memo[i]
+
+        def walk(i):
+            nonlocal found
+            if i == groups:
+                misc = next((m for m in range(numa_nodes) if crem[m] >= cpu_req[-1]), None)
+                if misc is None:
+                    return
+
+                # With the NUMA node of every group fixed, let the NIC solver place bandwidth on the interfaces
+                nics = NumaSolver.NicAssignment(nic_req, nic_free, numa_map=cur)
+                if nics is None:
+                    return
+
+                found += 1
+                yield {'gpu': tuple(cur), 'cpu': tuple(cur) + (misc,), 'nic': nics}
+                return
+
+            if left[i][0] > sum(x[0] for x in spare) or left[i][1] > sum(x[1] for x in spare):
+                return
+
+            for n in range(numa_nodes):
+                if grem[n] < gpu_req[i] or crem[n] < cpu_req[i]:
+                    continue
+
+                on_numa[n].append(tuple(nic_req[i]))
+                if not nic_packable(n):
+                    on_numa[n].pop()
+                    continue
+
+                grem[n] -= gpu_req[i]
+                crem[n] -= cpu_req[i]
+                spare[n][0] -= nic_req[i][0]
+                spare[n][1] -= nic_req[i][1]
+                if NumaSolver.Feasible(gpu_req[i+1:], grem, memo_for(gmemo, i+1)) and \
+                   NumaSolver.Feasible(cpu_req[i+1:], crem, memo_for(cmemo, i+1)):
+                    cur.append(n)
+                    yield from walk(i+1)
+                    cur.pop()
+
+                grem[n] += gpu_req[i]
+                crem[n] += cpu_req[i]
+                spare[n][0] += nic_req[i][0]
+                spare[n][1] += nic_req[i][1]
+                on_numa[n].pop()
+
+                if limit and found >= limit:
+                    return
+
+        yield from walk(0)
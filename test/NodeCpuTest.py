@@ -0,0 +1,65 @@
+import sys
+import unittest
+
+sys.path.insert(0, '../')
+from nhd.Node import Node
+from nhd.Node import NodeCpuMap
+from nhd.Matcher import Matcher
+from nhd.CfgTopology import CfgTopology, Core, NICCoreDirection, NUMASetting, SMTSetting, TopologyMapType, VLANInfo
+
+LABELS = {
+    'feature.node.kubernetes.io/nfd-extras-cpu.num_cores': '8',
+    'feature.node.kubernetes.io/nfd-extras-cpu.num_sockets': '2',
+    'feature.node.kubernetes.io/nfd-extras-cpu.isolcpus': '2-7_10-15',
+    'feature.node.kubernetes.io/cpu-hardware_multithreading': 'true',
+    'DATA_PLANE_VLAN': '100',
+    'DATA_DEFAULT_GW': '1.2.3.4',
+}
+
+"""
+CPU core hand-out on SMT nodes. Requests with SMT disabled get the first thread of every free physical core on the
+socket, then the sibling threads of those cores, the same way a walk over every logical core hands them out.
+"""
+class NodeCpuTest(unittest.TestCase):
+    def MakeNode(self) -> Node:
+        n = Node('n0')
+        self.assertTrue(n.ParseLabels(LABELS))
+        n.SetHugepages(32, 32)
+        return n
+
+    def MiscTopology(self, num, smt) -> CfgTopology:
+        t = CfgTopology()
+        t.map_type = TopologyMapType.TOPOLOGY_MAP_NUMA
+        t.ctrl_vlan = VLANInfo('kni', 0)
+        t.misc_cores_smt = smt
+        for i in range(num):
+            t.AddMiscCore(Core(f'misc{i}', 0, NICCoreDirection.NIC_CORE_DIRECTION_NONE, NUMASetting.LOGICAL_NUMA_DONT_CARE, 0))
+
+        return t
+
+    def testSmtDisabledBatch(self):
+        cpus = NodeCpuMap(8, 2, True)
+        self.assertEqual(cpus.GetFreeBatch(1, 5, SMTSetting.SMT_DISABLED), [4, 5, 6, 7, 12])
+        self.assertEqual(cpus.GetFreeBatch(1, 8, SMTSetting.SMT_DISABLED), [4, 5, 6, 7, 12, 13, 14, 15])
+        self.assertEqual(cpus.GetFreeBatch(1, 5, SMTSetting.SMT_ENABLED), [4, 12, 5, 13, 6])
+
+        cpus.SetUsed(5, True)
+        self.assertEqual(cpus.GetFreeBatch(1, 4, SMTSetting.SMT_DISABLED), [4, 6, 7, 12])
+
+    def testSmtDisabledMiscCores(self):
+        """ Two SMT-disabled misc cores are sized as one physical core by the matcher, so a socket with a single free
+            physical core must still hand out both of its threads """
+        n = self.MakeNode()
+        for c in (3, 4, 5, 6, 7, 11, 12, 13, 14, 15):
+            n.SetCoreUsed(c, True)
+
+        top = self.MiscTopology(2, SMTSetting.SMT_DISABLED)
+        node, mapping = Matcher().FindNode({'n0': n}, top)[:2]
+        self.assertEqual(node, 'n0')
+
+        n.SetPhysicalIdsFromMapping(mapping, top, 'pod', 'ns')
+        self.assertEqual(sorted(c.core for c in top.misc_cores), [2, 10])
+
+
+if __name__ == '__main__':
+    unittest.main()